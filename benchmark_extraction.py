@@ -0,0 +1,226 @@
+import io
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+
+from pathlib import Path
+from build_db import DatabaseManager, EXTRACTION_QUERIES
+from build_db import create_empty_database, build_database, sync_database
+
+# builds a fake stash database (only the tables/columns we read), runs every extraction strategy
+# against it, and checks they all return the same rows
+# it also builds our database from each strategy, which has to come out the same,
+# and syncs it again right away, which has to find nothing to do
+
+parser = argparse.ArgumentParser(description="Benchmark stash extraction queries")
+parser.add_argument("--files", type=int, default=100000, help="Number of fake files")
+parser.add_argument("--runs", type=int, default=3, help="Runs per strategy")
+parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+
+def create_stash_schema(cursor):
+    # trimmed down version of stash's schema, keys and indexes match stash's
+    cursor.executescript("""
+        CREATE TABLE folders (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL
+        );
+        CREATE TABLE files (
+            id INTEGER PRIMARY KEY,
+            basename TEXT NOT NULL,
+            parent_folder_id INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE files_fingerprints (
+            file_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            fingerprint BLOB NOT NULL,
+            PRIMARY KEY (file_id, type, fingerprint)
+        );
+        CREATE INDEX index_fingerprint_type_fingerprint ON files_fingerprints (type, fingerprint);
+        CREATE TABLE video_files (
+            file_id INTEGER PRIMARY KEY,
+            duration REAL NOT NULL,
+            video_codec TEXT NOT NULL,
+            format TEXT NOT NULL,
+            audio_codec TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            frame_rate REAL NOT NULL,
+            bit_rate INTEGER NOT NULL
+        );
+        CREATE TABLE scenes_files (
+            scene_id INTEGER NOT NULL,
+            file_id INTEGER NOT NULL,
+            PRIMARY KEY (scene_id, file_id)
+        );
+        CREATE INDEX index_scenes_files_file_id ON scenes_files (file_id);
+        """)
+
+
+def populate_stash_database(database_path, file_count, seed):
+    rng = random.Random(seed)
+
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+    create_stash_schema(cursor)
+
+    folder_count = max(1, file_count // 100)
+    cursor.executemany(
+        "INSERT INTO folders (id, path) VALUES (?, ?)",
+        [
+            (
+                folder_id,
+                f"D:\\collections\\isos\\model{folder_id % 500}\\set{folder_id}",
+            )
+            for folder_id in range(1, folder_count + 1)
+        ],
+    )
+
+    files = []
+    fingerprints = []
+    video_files = []
+    scenes_files = []
+    for file_id in range(1, file_count + 1):
+        is_video = rng.random() < 0.6
+        extension = rng.choice(
+            [".mp4", ".mkv", ".wmv"] if is_video else [".jpg", ".png"]
+        )
+
+        # a few files point at folders that don't exist, to cover the '/' fallback
+        parent_folder_id = rng.randint(1, folder_count + 5)
+        files.append(
+            (
+                file_id,
+                f"file{file_id}{extension}",
+                parent_folder_id,
+                rng.randint(1, 10**10),
+            )
+        )
+
+        # some files haven't been fingerprinted yet
+        if rng.random() < 0.97:
+            fingerprints.append((file_id, "md5", format(rng.getrandbits(128), "032x")))
+            fingerprints.append(
+                (file_id, "oshash", format(rng.getrandbits(64), "016x"))
+            )
+
+        if is_video:
+            if rng.random() < 0.9:
+                fingerprints.append((file_id, "phash", rng.getrandbits(64) - (1 << 63)))
+
+            video_files.append(
+                (
+                    file_id,
+                    rng.uniform(10, 7200),
+                    rng.choice(["h264", "hevc"]),
+                    rng.choice(["mp4", "matroska"]),
+                    "aac",
+                    1920,
+                    1080,
+                    rng.choice([23.976, 29.97, 60.0]),
+                    rng.randint(10**5, 10**7),
+                )
+            )
+
+            # most videos are in one scene, some are in none, some are in several
+            for _ in range(rng.choice([0, 1, 1, 1, 1, 2])):
+                scenes_files.append((rng.randint(1, file_count), file_id))
+
+    cursor.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", files)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO files_fingerprints VALUES (?, ?, ?)", fingerprints
+    )
+    cursor.executemany(
+        "INSERT INTO video_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", video_files
+    )
+    cursor.executemany("INSERT OR IGNORE INTO scenes_files VALUES (?, ?)", scenes_files)
+
+    conn.commit()
+    conn.close()
+
+
+def benchmark_strategy(database_path, strategy, runs):
+    timings = []
+    rows = None
+    for _ in range(runs):
+        start_time = time.time()
+        with DatabaseManager(database_path) as source_db:
+            rows = source_db.read_data_from_db(strategy=strategy)
+        timings.append(time.time() - start_time)
+    return min(timings), rows
+
+
+def check_resync(database_path, strategy, output_path):
+    # (inserted, changed, removed) from syncing a freshly built database against the same source
+    # the build and sync print their own progress, we only want the counts
+    with contextlib.redirect_stdout(io.StringIO()):
+        create_empty_database(output_path)
+        build_database(database_path, output_path, strategy=strategy)
+        return sync_database(database_path, output_path, strategy=strategy)
+
+
+def rows_by_file_id(rows):
+    return {row[0]: row for row in rows}
+
+
+def read_files_table(output_path):
+    conn = sqlite3.connect(output_path)
+    files = conn.execute("SELECT * FROM files ORDER BY file_id").fetchall()
+    conn.close()
+    return files
+
+
+def main():
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_path = Path(temp_dir) / "stash.sqlite"
+
+        print(f"Building fake stash database with {args.files} files.")
+        populate_stash_database(database_path, args.files, args.seed)
+        print()
+
+        results = {}
+        for strategy in EXTRACTION_QUERIES:
+            best_time, rows = benchmark_strategy(database_path, strategy, args.runs)
+            results[strategy] = (best_time, rows)
+            print(
+                f"{strategy}: {best_time:.2f} seconds ({len(rows)} rows, best of {args.runs})"
+            )
+        print()
+
+        # row order isn't part of the contract, but there has to be exactly one row per file_id,
+        # since the upsert keeps whichever row for a file_id comes last
+        expected_time, expected_rows = results["legacy"]
+        expected_rows = rows_by_file_id(expected_rows)
+        for strategy, (best_time, rows) in results.items():
+            rows_by_id = rows_by_file_id(rows)
+            assert len(rows_by_id) == len(rows), f"{strategy} returned duplicate file_ids"
+            assert rows_by_id == expected_rows, f"{strategy} returned different rows"
+            print(f"{strategy}: rows match, {expected_time / best_time:.2f}x vs legacy")
+        print()
+
+        # what actually ends up in our database, after restructure_rows and the upsert
+        expected_files = None
+        for strategy in EXTRACTION_QUERIES:
+            output_path = Path(temp_dir) / f"{strategy}.sqlite"
+            inserted, changed, removed = check_resync(
+                database_path, strategy, output_path
+            )
+            assert (
+                inserted == changed == removed == 0
+            ), f"{strategy}: resync found {inserted} new, {changed} changed, {removed} removed files"
+
+            files = read_files_table(output_path)
+            if expected_files is None:
+                expected_files = files
+            assert files == expected_files, f"{strategy} built a different files table"
+            print(f"{strategy}: files table matches, resync found nothing to do")
+
+
+if __name__ == "__main__":
+    main()
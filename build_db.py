@@ -1,13 +1,142 @@
 import os
 import time
 import sqlite3
+import itertools
+import contextlib
 
+from phash_index import phash_to_signed
+from phash_checkpoint import rehydrate_database
 from user_config import database_path, stash_database_path
+from user_config import phash_checkpoint_path, phash_cache_max_entries
 from user_config import image_extensions, video_extensions
 
 
 DESTRUCTIVE_RUN = True
 
+FILES_COLUMNS = [
+    "file_id",
+    "scene_id",
+    "file_model",
+    "file_basename",
+    "file_parent",
+    "file_path",
+    "file_size",
+    "media_type",
+    "ohash",
+    "phash",
+    "md5",
+    "duration",
+    "video_codec",
+    "audio_codec",
+    "video_format",
+    "width",
+    "height",
+    "bit_rate",
+    "frame_rate",
+]
+
+UPSERT_QUERY = """
+    INSERT OR REPLACE INTO files (
+        file_id, scene_id, file_model, file_basename, file_parent,
+        file_path, file_size, media_type, ohash, phash, md5, duration, video_codec,
+        audio_codec, video_format, width, height, bit_rate,
+        frame_rate
+    ) VALUES (
+        :file_id, :scene_id, :file_model, :file_basename, :file_parent,
+        :file_path, :file_size, :media_type, :ohash, :phash, :md5, :duration, :video_codec,
+        :audio_codec, :video_format, :width, :height, :bit_rate,
+        :frame_rate
+    )
+"""
+
+UPSERT_CHUNK_SIZE = 10000
+READ_BATCH_SIZE = 10000
+
+# both queries return exactly one row per file_id. a file can be in several scenes, but files is keyed
+# by file_id, so we always keep its lowest scene_id, otherwise every sync would see it as changed
+
+# the original query, pivots files_fingerprints under a GROUP BY over every column
+LEGACY_EXTRACTION_QUERY = """
+SELECT
+f.id AS file_id,
+f.basename AS file_basename,
+COALESCE((SELECT path FROM folders WHERE id = f.parent_folder_id), '/') AS parent_folder_path,
+f.size AS file_size,
+MAX(CASE WHEN ff.type = 'oshash' THEN ff.fingerprint END) AS ohash,
+MAX(CASE WHEN ff.type = 'phash' THEN ff.fingerprint END) AS phash,
+MAX(CASE WHEN ff.type = 'md5' THEN ff.fingerprint END) AS md5,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.duration ELSE NULL END AS duration,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.video_codec ELSE NULL END AS video_codec,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.audio_codec ELSE NULL END AS audio_codec,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.format ELSE NULL END AS format,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.width ELSE NULL END AS width,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.height ELSE NULL END AS height,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.bit_rate ELSE NULL END AS bit_rate,
+CASE WHEN vf.file_id IS NOT NULL THEN vf.frame_rate ELSE NULL END AS frame_rate,
+(SELECT MIN(scene_id) FROM scenes_files WHERE file_id = f.id) AS scene_id
+FROM
+files f
+LEFT JOIN
+files_fingerprints ff ON f.id = ff.file_id
+LEFT JOIN
+video_files vf ON f.id = vf.file_id
+GROUP BY
+f.id, f.basename, parent_folder_path, file_size, duration, video_codec, audio_codec, format, width, height, bit_rate, frame_rate, scene_id
+"""
+
+# same rows, but fingerprints are pivoted once per file_id (which streams straight off the
+# files_fingerprints primary key) and then joined, so there's no big GROUP BY over every column
+PREAGGREGATED_EXTRACTION_QUERY = """
+WITH fingerprints AS (
+    SELECT
+    file_id,
+    MAX(CASE WHEN type = 'oshash' THEN fingerprint END) AS ohash,
+    MAX(CASE WHEN type = 'phash' THEN fingerprint END) AS phash,
+    MAX(CASE WHEN type = 'md5' THEN fingerprint END) AS md5
+    FROM
+    files_fingerprints
+    GROUP BY
+    file_id
+)
+SELECT
+f.id AS file_id,
+f.basename AS file_basename,
+COALESCE(fo.path, '/') AS parent_folder_path,
+f.size AS file_size,
+fp.ohash AS ohash,
+fp.phash AS phash,
+fp.md5 AS md5,
+vf.duration AS duration,
+vf.video_codec AS video_codec,
+vf.audio_codec AS audio_codec,
+vf.format AS format,
+vf.width AS width,
+vf.height AS height,
+vf.bit_rate AS bit_rate,
+vf.frame_rate AS frame_rate,
+(SELECT MIN(scene_id) FROM scenes_files WHERE file_id = f.id) AS scene_id
+FROM
+files f
+LEFT JOIN
+folders fo ON fo.id = f.parent_folder_id
+LEFT JOIN
+fingerprints fp ON fp.file_id = f.id
+LEFT JOIN
+video_files vf ON vf.file_id = f.id
+"""
+
+EXTRACTION_QUERIES = {
+    "legacy": LEGACY_EXTRACTION_QUERY,
+    "preaggregated": PREAGGREGATED_EXTRACTION_QUERY,
+}
+
+# only used while rebuilding from scratch, if the load dies we just rebuild again
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "OFF",
+    "synchronous": "OFF",
+    "cache_size": -256 * 1024,  # negative is KiB, so 256 MB
+}
+
 
 class DatabaseManager:
     def __init__(self, database_path):
@@ -29,62 +158,97 @@ class DatabaseManager:
     def fetch_rows(self):
         return self.cursor.fetchall()
 
-    def upsert_data(self, data):
-        total_rows = len(data)
-        print(f"Total rows to upsert: {total_rows}\n")
-
-        for row in data:
-            self.cursor.execute(
-                """
-                INSERT OR REPLACE INTO files (
-                    file_id, scene_id, file_model, file_basename, file_parent,
-                    file_path, file_size, media_type, ohash, phash, md5, duration, video_codec,
-                    audio_codec, video_format, width, height, bit_rate,
-                    frame_rate
-                ) VALUES (
-                    :file_id, :scene_id, :file_model, :file_basename, :file_parent,
-                    :file_path, :file_size, :media_type, :ohash, :phash, :md5, :duration, :video_codec,
-                    :audio_codec, :video_format, :width, :height, :bit_rate,
-                    :frame_rate
-                )
-            """,
-                row,
-            )
-
-    def read_data_from_db(self):
-        query = """
-        SELECT
-        f.id AS file_id,
-        f.basename AS file_basename,
-        COALESCE((SELECT path FROM folders WHERE id = f.parent_folder_id), '/') AS parent_folder_path,
-        f.size AS file_size,
-        MAX(CASE WHEN ff.type = 'oshash' THEN ff.fingerprint END) AS ohash,
-        MAX(CASE WHEN ff.type = 'phash' THEN ff.fingerprint END) AS phash,
-        MAX(CASE WHEN ff.type = 'md5' THEN ff.fingerprint END) AS md5,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.duration ELSE NULL END AS duration,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.video_codec ELSE NULL END AS video_codec,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.audio_codec ELSE NULL END AS audio_codec,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.format ELSE NULL END AS format,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.width ELSE NULL END AS width,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.height ELSE NULL END AS height,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.bit_rate ELSE NULL END AS bit_rate,
-        CASE WHEN vf.file_id IS NOT NULL THEN vf.frame_rate ELSE NULL END AS frame_rate,
-        sf.scene_id AS scene_id
-        FROM
-        files f
-        LEFT JOIN
-        files_fingerprints ff ON f.id = ff.file_id
-        LEFT JOIN
-        video_files vf ON f.id = vf.file_id
-        LEFT JOIN
-        scenes_files sf ON f.id = sf.file_id
-        GROUP BY
-        f.id, f.basename, parent_folder_path, file_size, duration, video_codec, audio_codec, format, width, height, bit_rate, frame_rate, scene_id
-        """
+    def upsert_data(self, data, chunk_size=UPSERT_CHUNK_SIZE):
+        # data can be a list, or a generator so the whole library never has to sit in memory
+        rows = iter(data)
+        total_rows = 0
+        start_time = time.time()
+
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            self.cursor.executemany(UPSERT_QUERY, chunk)
+            total_rows += len(chunk)
+
+            elapsed = time.time() - start_time
+            rate = total_rows / elapsed if elapsed > 0 else 0
+            print(f"Upserted {total_rows} rows ({rate:.0f} rows/s)", end="\r")
+
+        print(f"Upserted {total_rows} rows in {time.time() - start_time:.2f} seconds.\n")
+        return total_rows
+
+    @contextlib.contextmanager
+    def bulk_load(self, table="files"):
+        # loosen durability while loading, and drop the table's indexes so they're built once at the end
+        # instead of being updated on every insert. everything is put back when we're done
+        previous_pragmas = {}
+        for pragma, value in BULK_LOAD_PRAGMAS.items():
+            self.cursor.execute(f"PRAGMA {pragma}")
+            previous_pragmas[pragma] = self.cursor.fetchone()[0]
+            self.cursor.execute(f"PRAGMA {pragma} = {value}")
+
+        # autoindexes (primary keys, unique) have no sql and can't be dropped, so we leave them
+        self.cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,),
+        )
+        deferred_indexes = self.cursor.fetchall()
+        for name, _ in deferred_indexes:
+            self.cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+        try:
+            yield
+        finally:
+            self.conn.commit()
+
+            if deferred_indexes:
+                print("Creating indexes.")
+                start_time = time.time()
+                for _, sql in deferred_indexes:
+                    self.cursor.execute(sql)
+                self.conn.commit()
+                print(f"Indexes created in {time.time() - start_time:.2f} seconds.\n")
+
+            for pragma, value in previous_pragmas.items():
+                self.cursor.execute(f"PRAGMA {pragma} = {value}")
+
+    def iter_local_rows(self, batch_size=READ_BATCH_SIZE):
+        # ordered by file_id, which is the rowid, so this walks the table without sorting it
+        # on its own cursor, so upserts can run on self.cursor while we read
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT {', '.join(FILES_COLUMNS)} FROM files ORDER BY file_id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(FILES_COLUMNS, row))
+        cursor.close()
+
+    def delete_file_ids(self, file_ids):
+        self.cursor.executemany(
+            "DELETE FROM files WHERE file_id = ?", [(file_id,) for file_id in file_ids]
+        )
+
+    def read_data_from_db(self, strategy="legacy"):
+        return list(self.iter_data_from_db(strategy=strategy))
+
+    def iter_data_from_db(
+        self, batch_size=READ_BATCH_SIZE, strategy="legacy", ordered=False
+    ):
+        query = EXTRACTION_QUERIES[strategy]
+        if ordered:
+            # sync merges these against our own rows, so both sides have to come in file_id order
+            query = f"SELECT * FROM ({query}) ORDER BY file_id"
 
         self.execute_query(query)
-        rows = self.fetch_rows()
-        return rows
+        while True:
+            rows = self.cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
 
     def __enter__(self):
         self.connect()
@@ -100,76 +264,150 @@ def check_database_exists(database_path):
         exit()
 
 
-def convert_to_hex(i: int) -> str:
-    u = i + (1 << 64)
-    h = hex(u)
-    encoded_hex = h[2:]
-    return encoded_hex
+def restructure_row(row):
+    file_path = None
+    media_type = None
+    file_model = None
+
+    # the model is the fourth folder down, files directly in a shallower folder (or in '/',
+    # when stash has lost the parent folder) don't have one
+    if row[2]:
+        folders = row[2].split("\\")
+        if len(folders) > 3:
+            file_model = folders[3]
+
+    if row[2] and row[1]:
+        file_path = os.path.join(row[2], row[1])
+
+    if row[1] and (
+        row[1].endswith(tuple(image_extensions))
+        or row[1].endswith(tuple(video_extensions))
+    ):
+        if row[1].endswith(tuple(image_extensions)):
+            media_type = "image"
+        elif row[1].endswith(tuple(video_extensions)):
+            media_type = "video"
+
+    return {
+        "file_id": row[0] or None,
+        "scene_id": row[15] or None,
+        "file_model": file_model,
+        "file_basename": row[1] or None,
+        "file_parent": row[2].replace("\\", "/") if row[2] else None,
+        "file_path": file_path or None,
+        "file_size": row[3] or None,
+        "media_type": media_type or None,
+        "ohash": row[4] or None,
+        "phash": phash_to_signed(row[5]) if row[5] else None,
+        "md5": row[6] or None,
+        "duration": row[7] or None,
+        "video_codec": row[8] or None,
+        "audio_codec": row[9] or None,
+        "video_format": row[10] or None,
+        "width": row[11] or None,
+        "height": row[12] or None,
+        "bit_rate": row[13] or None,
+        "frame_rate": row[14] or None,
+    }
 
 
 def restructure_rows(rows):
-    restructured_rows = []
-
+    # lazy, one row at a time, so it can sit between a fetchmany reader and a chunked upsert
     for row in rows:
-        if row[2] and row[1]:
-            file_path = os.path.join(row[2], row[1])
+        yield restructure_row(row)
 
-        if row[1] and (
-            row[1].endswith(tuple(image_extensions))
-            or row[1].endswith(tuple(video_extensions))
-        ):
-            if row[1].endswith(tuple(image_extensions)):
-                media_type = "image"
-            elif row[1].endswith(tuple(video_extensions)):
-                media_type = "video"
-
-        reorganized_row = {
-            "file_id": row[0] or None,
-            "scene_id": row[15] or None,
-            "file_model": row[2].split("\\")[3] if row[2] else None,
-            "file_basename": row[1] or None,
-            "file_parent": row[2].replace("\\", "/") if row[2] else None,
-            "file_path": file_path or None,
-            "file_size": row[3] or None,
-            "media_type": media_type or None,
-            "ohash": row[4] or None,
-            "phash": convert_to_hex(row[5]) if row[5] else None,
-            "md5": row[6] or None,
-            "duration": row[7] or None,
-            "video_codec": row[8] or None,
-            "audio_codec": row[9] or None,
-            "video_format": row[10] or None,
-            "width": row[11] or None,
-            "height": row[12] or None,
-            "bit_rate": row[13] or None,
-            "frame_rate": row[14] or None,
-        }
-        restructured_rows.append(reorganized_row)
-
-    return restructured_rows
-
-
-def build_database(source_database_path, destination_database_path):
+
+def build_database(source_database_path, destination_database_path, strategy="legacy"):
     check_database_exists(source_database_path)
 
-    print("Reading data from source database.")
-    with DatabaseManager(source_database_path) as source_db:
-        data_rows = source_db.read_data_from_db()
+    # stash rows are read with fetchmany, restructured one at a time, and upserted in chunks
+    # so memory stays flat no matter how big the library is
+    print("Streaming data from source database into new database.\n")
+    with DatabaseManager(source_database_path) as source_db, DatabaseManager(
+        destination_database_path
+    ) as destination_db:
+        with destination_db.bulk_load():
+            destination_db.upsert_data(
+                restructure_rows(source_db.iter_data_from_db(strategy=strategy))
+            )
+
+
+def diff_rows(source_rows, local_rows, counts, deleted_file_ids):
+    # merge-joins stash's rows against ours, both sorted by file_id, and yields only what needs writing
+    # so it can feed upsert_data directly. counts and deleted_file_ids fill up as it's consumed
+    # phashes we generated ourselves (images) are kept, as long as the md5 says the content hasn't changed
+    local_rows = iter(local_rows)
+    local_row = next(local_rows, None)
+
+    for row in source_rows:
+        counts["total"] += 1
+        file_id = row["file_id"]
+
+        # anything of ours that stash skipped past is gone from stash
+        while local_row is not None and local_row["file_id"] < file_id:
+            deleted_file_ids.append(local_row["file_id"])
+            local_row = next(local_rows, None)
+
+        if local_row is None or local_row["file_id"] != file_id:
+            counts["inserted"] += 1
+            yield row
+            continue
+
+        if (
+            row["phash"] is None
+            and local_row["phash"] is not None
+            and row["md5"] == local_row["md5"]
+        ):
+            row["phash"] = local_row["phash"]
 
-    print("Restructuring data for new database.\n")
-    restructured_rows = restructure_rows(data_rows)
+        if row != local_row:
+            counts["changed"] += 1
+            yield row
 
-    with DatabaseManager(destination_database_path) as destination_db:
-        print("Upserting data into new database.")
-        destination_db.upsert_data(restructured_rows)
+        local_row = next(local_rows, None)
+
+    while local_row is not None:
+        deleted_file_ids.append(local_row["file_id"])
+        local_row = next(local_rows, None)
+
+
+def sync_database(source_database_path, destination_database_path, strategy="legacy"):
+    check_database_exists(source_database_path)
+
+    with DatabaseManager(source_database_path) as source_db, DatabaseManager(
+        destination_database_path
+    ) as destination_db:
+        # both sides are streamed in file_id order, so neither library has to fit in memory
+        # upserts only ever touch file_ids the local cursor has already passed, so reading and writing
+        # the same table at once is safe. deletes wait until the read is done
+        print("Comparing source database against existing database.")
+        counts = {"total": 0, "inserted": 0, "changed": 0}
+        deleted_file_ids = []
+        destination_db.upsert_data(
+            diff_rows(
+                restructure_rows(
+                    source_db.iter_data_from_db(strategy=strategy, ordered=True)
+                ),
+                destination_db.iter_local_rows(),
+                counts,
+                deleted_file_ids,
+            )
+        )
+        if deleted_file_ids:
+            destination_db.delete_file_ids(deleted_file_ids)
         destination_db.conn.commit()
 
+        print(f"New files: {counts['inserted']}")
+        print(f"Changed files: {counts['changed']}")
+        print(f"Removed files: {len(deleted_file_ids)}")
+        unchanged = counts["total"] - counts["inserted"] - counts["changed"]
+        print(f"Unchanged files: {unchanged}\n")
 
-def create_empty_database(database_path):
-    print("Creating empty database.\n")
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
+    return counts["inserted"], counts["changed"], len(deleted_file_ids)
 
+
+def create_files_table(cursor):
+    # phash is the signed 64 bit int stash uses, hex is only for display
     cursor.execute(
         """CREATE TABLE IF NOT EXISTS files (
             file_id INTEGER PRIMARY KEY,
@@ -181,7 +419,7 @@ def create_empty_database(database_path):
             file_size INTEGER,
             media_type TEXT,
             ohash TEXT,
-            phash TEXT,
+            phash INTEGER,
             md5 TEXT,
             duration REAL,
             video_codec TEXT,
@@ -194,22 +432,114 @@ def create_empty_database(database_path):
         )"""
     )
 
+
+def create_phash_index(cursor):
+    # covers every column remove_dupes.py groups and filters on, so exact grouping never reads the table
+    # phash leads, so it also serves plain phash lookups
+    cursor.execute(
+        """CREATE INDEX IF NOT EXISTS idx_files_phash_group
+        ON files (phash, media_type, file_model, file_size, duration)"""
+    )
+
+
+def create_empty_database(database_path):
+    print("Creating empty database.\n")
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+
+    create_files_table(cursor)
+    create_phash_index(cursor)
+
+    conn.commit()
+    conn.close()
+
+
+def hex_phash_to_signed(phash):
+    if phash in (None, "", "None"):
+        return None
+    try:
+        return phash_to_signed(phash)
+    except ValueError:
+        return None
+
+
+def migrate_database(database_path):
+    # databases built before we stored phashes as integers have a TEXT phash column full of hex
+    # this converts them in place, so injected image phashes survive without a rebuild
+    if not database_path.exists():
+        return
+
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+
+    cursor.execute("PRAGMA table_info(files)")
+    column_types = {row[1]: row[2].upper() for row in cursor.fetchall()}
+
+    if column_types.get("phash") == "TEXT":
+        print("Migrating phash column from hex TEXT to INTEGER.\n")
+        conn.create_function("hex_phash_to_signed", 1, hex_phash_to_signed)
+
+        cursor.execute("ALTER TABLE files RENAME TO files_old")
+        create_files_table(cursor)
+        cursor.execute(
+            """
+            INSERT INTO files (
+                file_id, scene_id, file_model, file_basename, file_parent,
+                file_path, file_size, media_type, ohash, phash, md5, duration, video_codec,
+                audio_codec, video_format, width, height, bit_rate,
+                frame_rate
+            )
+            SELECT
+                file_id, scene_id, file_model, file_basename, file_parent,
+                file_path, file_size, media_type, ohash, hex_phash_to_signed(phash), md5, duration, video_codec,
+                audio_codec, video_format, width, height, bit_rate,
+                frame_rate
+            FROM files_old
+        """
+        )
+        cursor.execute("DROP TABLE files_old")
+
+    if column_types:
+        # the old phash-only index is redundant with idx_files_phash_group, and costs every write
+        cursor.execute("DROP INDEX IF EXISTS idx_files_phash")
+        create_phash_index(cursor)
+
     conn.commit()
     conn.close()
 
 
-def build_and_populate_database():
+def restore_cached_phashes(output_database_path):
+    # image phashes from image_phash_util.py are cached by content, so rebuilds and moved files keep them
+    if phash_checkpoint_path.exists():
+        rehydrate_database(
+            output_database_path, phash_checkpoint_path, phash_cache_max_entries
+        )
+
+
+def build_and_populate_database(incremental=False, strategy="legacy"):
     os.system("cls" if os.name == "nt" else "clear")
 
     start_time = time.time()
-    print("\nBuilding database...\n")
 
     output_database_path = database_path
 
+    # incremental only writes what changed in stash since the last build/sync,
+    # and keeps the image phashes image_phash_util.py injected
+    if incremental and output_database_path.exists():
+        print("\nSyncing database...\n")
+        migrate_database(output_database_path)
+        sync_database(stash_database_path, output_database_path, strategy=strategy)
+        restore_cached_phashes(output_database_path)
+
+        print(f"Database synced in {time.time() - start_time:.2f} seconds.")
+        print()
+        return
+
+    print("\nBuilding database...\n")
+
     # we dont keep persistant information in the database, so we can delete it each time we update it
     # especially since it builds in less than 30 seconds
-    # ideally we dont want to rebuild, but instead remove entries that no longer exist in the source database, and add new entries
-    # eventually we will
+    # if you want to keep the injected image phashes, use the incremental sync instead
 
     if output_database_path.exists():
         if DESTRUCTIVE_RUN:
@@ -228,7 +558,8 @@ def build_and_populate_database():
 
     create_empty_database(output_database_path)
 
-    build_database(stash_database_path, output_database_path)
+    build_database(stash_database_path, output_database_path, strategy=strategy)
+    restore_cached_phashes(output_database_path)
 
     print(f"Database built in {time.time() - start_time:.2f} seconds.")
     print()
@@ -236,7 +567,9 @@ def build_and_populate_database():
 
 def main():
     print("This script is not meant to be run as a standalone script.")
-    print("Please run remove_dupes.py with the --rebuild-database flag instead.")
+    print(
+        "Please run remove_dupes.py with the --rebuild-database or --sync-database flag instead."
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+import os
+import time
+import threading
+import concurrent.futures
+
+# answers "does this file exist" (and its size/mtime) from directory listings, instead of one
+# os.path.exists per file. on a network share every exists is a round trip, a listing is one
+# round trip for the whole folder, and folders are listed in parallel
+#
+# on windows the listing already includes size and mtime, elsewhere stat() is only called when asked for
+# listings are kept for ttl seconds, files we move or delete ourselves are dropped from them right away
+
+
+class DirectoryListingCache:
+    def __init__(self, ttl, workers):
+        self.ttl = ttl
+        self.workers = workers
+        self.listings = {}  # directory -> (listed at, {normcased name: DirEntry} or None)
+        self.lock = threading.Lock()
+
+    def list_directory(self, directory):
+        # None when the folder can't be listed (permissions, etc.), callers fall back to a plain exists
+        try:
+            with os.scandir(directory) as entries:
+                listing = {os.path.normcase(entry.name): entry for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            listing = {}
+        except OSError:
+            listing = None
+
+        with self.lock:
+            self.listings[directory] = (time.time(), listing)
+        return listing
+
+    def get_listing(self, directory):
+        with self.lock:
+            cached = self.listings.get(directory)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        return self.list_directory(directory)
+
+    def prefetch(self, file_paths):
+        # list every folder these files are in, once each, across the thread pool
+        now = time.time()
+        with self.lock:
+            directories = set(os.path.dirname(path) for path in file_paths) - set(
+                directory
+                for directory, (listed_at, _) in self.listings.items()
+                if now - listed_at < self.ttl
+            )
+
+        if not directories:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as executor:
+            list(executor.map(self.list_directory, directories))
+
+    def get_entry(self, file_path):
+        listing = self.get_listing(os.path.dirname(file_path))
+        if listing is None:
+            return None
+        return listing.get(os.path.normcase(os.path.basename(file_path)), False)
+
+    def exists(self, file_path):
+        entry = self.get_entry(file_path)
+        if entry is None:
+            return os.path.exists(file_path)
+        return entry is not False
+
+    def stat(self, file_path):
+        # (size, mtime), or None if the file doesn't exist
+        entry = self.get_entry(file_path)
+        try:
+            if entry is None:
+                stat = os.stat(file_path)
+            elif entry is False:
+                return None
+            else:
+                stat = entry.stat()
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def invalidate(self, file_path):
+        with self.lock:
+            cached = self.listings.get(os.path.dirname(file_path))
+            if cached is not None and cached[1] is not None:
+                cached[1].pop(os.path.normcase(os.path.basename(file_path)), None)
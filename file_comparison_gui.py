@@ -1,6 +1,4 @@
-import cv2
 import json
-import string
 import argparse
 import pyperclip
 import screeninfo
@@ -9,12 +7,13 @@ import tkinter as tk
 import pygetwindow as gw
 import tkinter.messagebox as messagebox
 
-from pathlib import Path
 from PIL import ImageTk, Image
 
+from frame_cache import FrameCache
+from phash_index import phash_to_hex
 from user_config import blacklisted_phash_path
 from user_config import readable_size, readable_duration
-from user_config import extracted_frames_path, collections_directory
+from user_config import frame_cache_path, frame_cache_max_bytes, frame_cache_max_size
 
 
 def copy_to_clipboard(file_name):
@@ -31,33 +30,15 @@ def add_to_blacklist(phash):
 
 
 def extract_first_frame(file_path):
-    video_path = Path(file_path)
+    # same frame cache remove_dupes.py verifies with, so the video usually isn't decoded again here
+    with FrameCache(
+        frame_cache_path, frame_cache_max_bytes, frame_cache_max_size
+    ) as frame_cache:
+        frame_path = frame_cache.get_frame_path(file_path, "video")
 
-    relative_path = video_path.relative_to(collections_directory)
-
-    # Create the target directory structure inside the trash directory
-    target_dir = extracted_frames_path / relative_path.parent
-    target_dir.mkdir(parents=True, exist_ok=True)
-
-    video = cv2.VideoCapture(str(video_path))
-    success, frame = video.read()
-
-    def sanitize_filename(filename):
-        valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
-        sanitized_filename = "".join(c for c in filename if c in valid_chars)
-        return sanitized_filename
-
-    if success:
-        output_filename = sanitize_filename(video_path.stem)
-        output_file = target_dir / f"{output_filename}.jpg"
-
-        cv2.imwrite(str(output_file), frame)
-        video.release()
-
-        return str(output_file)
-
-    else:
+    if frame_path is None:
         return None
+    return str(frame_path)
 
 
 def kill_program_by_window_title(window_title):
@@ -92,7 +73,7 @@ data = json.loads(args.data)
 biggest_file_entry = data["biggest_file_entry"]
 smaller_file_entry = data["smaller_file_entry"]
 
-biggest_file_phash = biggest_file_entry["phash"]
+biggest_file_phash = phash_to_hex(biggest_file_entry["phash"])
 
 biggest_file_entry_file_path = biggest_file_entry["file_path"]
 smaller_file_entry_file_path = smaller_file_entry["file_path"]
@@ -0,0 +1,232 @@
+import sys
+import array
+import numpy as np
+
+# compact storage for the rows remove_dupes.py loads, instead of a 17 key dict per file
+# a FileTable keeps every field as one column: numbers in numpy arrays, the text columns that repeat
+# across thousands of files (models, folders, codecs) as codes into one shared table of strings,
+# and basenames packed back to back in a single utf-8 buffer. file_path isn't stored at all,
+# it's rebuilt from a shared folder prefix plus the basename
+#
+# a FileRecord is a small view (table, row) handed out for the files that end up in a group,
+# it still reads like the dicts did, entry["file_path"] and entry.get("width") both work
+
+FILE_RECORD_FIELDS = (
+    "file_id",
+    "scene_id",
+    "file_model",
+    "file_basename",
+    "file_parent",
+    "file_path",
+    "file_size",
+    "media_type",
+    "phash",
+    "duration",
+    "video_codec",
+    "audio_codec",
+    "video_format",
+    "width",
+    "height",
+    "bit_rate",
+    "frame_rate",
+)
+
+INTEGER_FIELDS = (
+    "file_id",
+    "scene_id",
+    "file_size",
+    "phash",
+    "width",
+    "height",
+    "bit_rate",
+)
+FLOAT_FIELDS = ("duration", "frame_rate")
+INTERNED_FIELDS = (
+    "file_model",
+    "file_parent",
+    "media_type",
+    "video_codec",
+    "audio_codec",
+    "video_format",
+)
+
+FIELD_INDEXES = {field: index for index, field in enumerate(FILE_RECORD_FIELDS)}
+
+# string code for NULL
+NO_STRING = -1
+
+
+class FileTable:
+    def __init__(self, rows):
+        # rows come from PHASH_ROW_COLUMNS, which already turns "" and "None" into NULL
+        # they're read one at a time into typed arrays, so a cursor can be passed straight in
+        self.strings = []
+        self.string_codes = {}
+
+        integers = {field: array.array("q") for field in INTEGER_FIELDS}
+        integers_present = {field: bytearray() for field in INTEGER_FIELDS}
+        floats = {field: array.array("d") for field in FLOAT_FIELDS}
+        codes = {field: array.array("i") for field in INTERNED_FIELDS}
+        path_prefixes = array.array("i")
+        self.full_paths = {}  # row -> file_path, for the odd path that doesn't end in its basename
+        basenames = bytearray()
+        basename_ends = array.array("q")
+
+        integer_columns = [
+            (FIELD_INDEXES[field], integers[field], integers_present[field])
+            for field in INTEGER_FIELDS
+        ]
+        float_columns = [(FIELD_INDEXES[field], floats[field]) for field in FLOAT_FIELDS]
+        code_columns = [(FIELD_INDEXES[field], codes[field]) for field in INTERNED_FIELDS]
+        basename_index = FIELD_INDEXES["file_basename"]
+        path_index = FIELD_INDEXES["file_path"]
+
+        for row_number, row in enumerate(rows):
+            for index, column, present in integer_columns:
+                value = row[index]
+                column.append(0 if value is None else int(value))
+                present.append(value is not None)
+
+            for index, column in float_columns:
+                value = row[index]
+                column.append(np.nan if value is None else float(value))
+
+            for index, column in code_columns:
+                column.append(self.intern(row[index]))
+
+            basename = row[basename_index]
+            if basename is not None:
+                basenames += basename.encode("utf-8")
+            basename_ends.append(len(basenames))
+
+            # every file in a folder shares the same prefix, so this costs one code per file
+            file_path = row[path_index]
+            if file_path is None:
+                path_prefixes.append(NO_STRING)
+            elif basename and file_path.endswith(basename):
+                path_prefixes.append(self.intern(file_path[: -len(basename)]))
+            else:
+                path_prefixes.append(NO_STRING)
+                self.full_paths[row_number] = file_path
+
+        self.integers = {
+            field: np.frombuffer(column, dtype=np.int64)
+            for field, column in integers.items()
+        }
+        self.integers_present = {
+            field: np.frombuffer(present, dtype=np.bool_)
+            for field, present in integers_present.items()
+        }
+        self.floats = {
+            field: np.frombuffer(column, dtype=np.float64)
+            for field, column in floats.items()
+        }
+        self.codes = {
+            field: np.frombuffer(column, dtype=np.int32) for field, column in codes.items()
+        }
+        self.path_prefixes = np.frombuffer(path_prefixes, dtype=np.int32)
+        self.basenames = bytes(basenames)
+        self.basename_ends = np.frombuffer(basename_ends, dtype=np.int64)
+
+    def intern(self, value):
+        if value is None:
+            return NO_STRING
+        code = self.string_codes.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(sys.intern(value))
+            self.string_codes[value] = code
+        return code
+
+    def __len__(self):
+        return len(self.basename_ends)
+
+    def string(self, code):
+        return None if code == NO_STRING else self.strings[code]
+
+    def basename(self, row):
+        start = int(self.basename_ends[row - 1]) if row else 0
+        end = int(self.basename_ends[row])
+        if start == end:
+            return None
+        return self.basenames[start:end].decode("utf-8")
+
+    def value(self, row, field):
+        if field in self.integers:
+            if not self.integers_present[field][row]:
+                return None
+            return int(self.integers[field][row])
+        if field in self.floats:
+            value = float(self.floats[field][row])
+            return None if value != value else value
+        if field in self.codes:
+            return self.string(int(self.codes[field][row]))
+        if field == "file_basename":
+            return self.basename(row)
+        if field == "file_path":
+            prefix = int(self.path_prefixes[row])
+            if prefix == NO_STRING:
+                return self.full_paths.get(row)
+            return self.strings[prefix] + self.basename(row)
+        raise KeyError(field)
+
+
+class FileRecord:
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, key):
+        if key not in FIELD_INDEXES:
+            raise KeyError(key)
+        return self.table.value(self.row, key)
+
+    def get(self, key, default=None):
+        if key not in FIELD_INDEXES:
+            return default
+        return self.table.value(self.row, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, FileRecord):
+            return NotImplemented
+        return self.table is other.table and self.row == other.row
+
+    def __hash__(self):
+        return hash((id(self.table), self.row))
+
+    def __repr__(self):
+        return f"FileRecord({self.to_dict()!r})"
+
+    def to_dict(self):
+        # for json and printing, only built when asked for
+        return {field: self.table.value(self.row, field) for field in FILE_RECORD_FIELDS}
+
+
+def group_records_by_phash(table, blacklisted_phashes=()):
+    # exact grouping as one argsort over the phash column, instead of a dict append per file
+    # the sort is stable, so files keep their original order inside a group
+    # only the files that end up in a group get a FileRecord
+    phashes = table.integers["phash"]
+    order = np.argsort(phashes, kind="stable")
+    order = order[table.integers_present["phash"][order]]
+    if blacklisted_phashes:
+        blacklisted = np.fromiter(blacklisted_phashes, dtype=np.int64)
+        order = order[~np.isin(phashes[order], blacklisted)]
+    if not len(order):
+        return {}
+
+    sorted_phashes = phashes[order]
+    starts = np.flatnonzero(
+        np.concatenate(([True], sorted_phashes[1:] != sorted_phashes[:-1]))
+    )
+    ends = np.append(starts[1:], len(order))
+
+    order = order.tolist()
+    groups = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        groups[int(sorted_phashes[start])] = [
+            FileRecord(table, row) for row in order[start:end]
+        ]
+    return groups
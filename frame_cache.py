@@ -0,0 +1,303 @@
+import os
+import cv2
+import time
+import numpy as np
+import sqlite3
+import hashlib
+import threading
+import concurrent.futures
+
+from pathlib import Path
+
+# downscaled first frames of videos/images, kept on disk so each file is only decoded once,
+# across groups, across models, and across runs. shared by remove_dupes.py and file_comparison_gui.py
+#
+# entries are keyed by path + size + mtime, so a file that changes on disk is decoded again
+# frames are stored as png (lossless), so the mse checks see exactly what was decoded
+# the index is a small sqlite db next to the frames, least recently used frames are evicted
+# once the frames add up to more than max_bytes
+#
+# besides first frames, it keeps the thumbnails videos are verified with (a few timestamps across
+# the whole video, stacked into one png), those are cached per path and per sampling setup ("variant")
+
+
+class FrameCache:
+    def __init__(self, cache_directory, max_bytes, max_size=0):
+        self.cache_directory = Path(cache_directory)
+        self.max_bytes = max_bytes
+        self.max_size = max_size  # longest side in pixels, 0 = keep full resolution
+        self.conn = None
+        self.cursor = None
+        # prefetch threads share the one connection, decoding happens outside the lock
+        self.lock = threading.Lock()
+        # key -> future of the frame, while one thread loads it. other threads asking for the same
+        # file (the biggest file of a group is in every comparison) wait for it instead of decoding again
+        self.in_flight = {}
+
+    def connect(self):
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(
+            self.cache_directory / "index.sqlite", check_same_thread=False
+        )
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        self.create_table()
+
+    def disconnect(self):
+        self.conn.commit()
+        self.cursor.close()
+        self.conn.close()
+
+    def create_table(self):
+        self.cursor.execute(
+            """CREATE TABLE IF NOT EXISTS frames (
+                key TEXT PRIMARY KEY,
+                file_path TEXT NOT NULL,
+                variant TEXT NOT NULL DEFAULT '',
+                bytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+
+        # caches from before video samples were cached only had first frames
+        self.cursor.execute("PRAGMA table_info(frames)")
+        if "variant" not in [row[1] for row in self.cursor.fetchall()]:
+            self.cursor.execute(
+                "ALTER TABLE frames ADD COLUMN variant TEXT NOT NULL DEFAULT ''"
+            )
+
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_frames_file_path ON frames (file_path)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_frames_last_used ON frames (last_used)"
+        )
+        self.conn.commit()
+
+    def make_key(self, file_path, variant=""):
+        # raises OSError when the file is gone, callers treat that as no frame
+        stat = os.stat(file_path)
+        key = f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}|{self.max_size}|{variant}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def frame_path(self, key):
+        # two levels of folders, so no single folder ends up with every frame in it
+        return self.cache_directory / key[:2] / f"{key}.png"
+
+    def lookup(self, key):
+        with self.lock:
+            self.cursor.execute("SELECT 1 FROM frames WHERE key = ?", (key,))
+            if self.cursor.fetchone() is None:
+                return None
+
+            cached_path = self.frame_path(key)
+            if not cached_path.is_file():
+                # deleted from under us, forget it and decode again
+                self.cursor.execute("DELETE FROM frames WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+
+            self.cursor.execute(
+                "UPDATE frames SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.conn.commit()
+            return cached_path
+
+    def decode_frame(self, file_path, media_type):
+        if media_type == "video":
+            capture = cv2.VideoCapture(str(file_path))
+            success, frame = capture.read()
+            capture.release()
+            if not success:
+                return None
+        else:
+            frame = cv2.imread(str(file_path))
+            if frame is None:
+                return None
+
+        return self.shrink(frame, self.max_size)
+
+    def shrink(self, frame, max_size):
+        height, width = frame.shape[:2]
+        if max_size and max(height, width) > max_size:
+            scale = max_size / max(height, width)
+            frame = cv2.resize(
+                frame,
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                interpolation=cv2.INTER_AREA,
+            )
+        return frame
+
+    def decode_video_samples(self, file_path, samples, thumbnail_size, duration=None):
+        # thumbnails of samples timestamps spread across the video, stacked top to bottom
+        # each seek lands on the keyframe before the timestamp and decodes forward from there,
+        # so a long video costs about samples keyframe decodes, not a decode from the start
+        capture = cv2.VideoCapture(str(file_path))
+        try:
+            if not capture.isOpened():
+                return None
+
+            if not duration:
+                fps = capture.get(cv2.CAP_PROP_FPS)
+                frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+                duration = frame_count / fps if fps and frame_count else None
+            if not duration:
+                return None
+
+            thumbnails = []
+            for i in range(samples):
+                # (i + 1) / (samples + 1) stays clear of the very first and last frames
+                capture.set(
+                    cv2.CAP_PROP_POS_MSEC, duration * 1000 * (i + 1) / (samples + 1)
+                )
+                if not capture.grab():
+                    return None
+                success, frame = capture.retrieve()
+                if not success:
+                    return None
+
+                thumbnail = self.shrink(frame, thumbnail_size)
+                if thumbnails and thumbnail.shape != thumbnails[0].shape:
+                    # resolution changed mid stream
+                    thumbnail = cv2.resize(
+                        thumbnail,
+                        thumbnails[0].shape[:2][::-1],
+                        interpolation=cv2.INTER_AREA,
+                    )
+                thumbnails.append(thumbnail)
+
+            return np.vstack(thumbnails)
+        finally:
+            capture.release()
+
+    def store(self, key, file_path, frame, variant=""):
+        cached_path = self.frame_path(key)
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # written under a temp name first, so nothing ever reads a half written frame
+        temp_path = cached_path.with_name(f"{key}.{threading.get_ident()}.tmp.png")
+        cv2.imwrite(str(temp_path), frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        os.replace(temp_path, cached_path)
+
+        with self.lock:
+            # older versions of the same file will never be asked for again
+            self.cursor.execute(
+                "SELECT key FROM frames WHERE file_path = ? AND variant = ? AND key != ?",
+                (str(file_path), variant, key),
+            )
+            stale_keys = [row[0] for row in self.cursor.fetchall()]
+            self.remove_entries(stale_keys)
+
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO frames (key, file_path, variant, bytes, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, str(file_path), variant, cached_path.stat().st_size, time.time()),
+            )
+            self.evict()
+            self.conn.commit()
+
+        return cached_path
+
+    def remove_entries(self, keys):
+        for key in keys:
+            try:
+                self.frame_path(key).unlink()
+            except FileNotFoundError:
+                pass
+        self.cursor.executemany(
+            "DELETE FROM frames WHERE key = ?", [(key,) for key in keys]
+        )
+
+    def evict(self):
+        self.cursor.execute("SELECT COALESCE(SUM(bytes), 0) FROM frames")
+        excess = self.cursor.fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted_keys = []
+        self.cursor.execute("SELECT key, bytes FROM frames ORDER BY last_used")
+        for key, size in self.cursor.fetchall():
+            if excess <= 0:
+                break
+            evicted_keys.append(key)
+            excess -= size
+        self.remove_entries(evicted_keys)
+
+    def get_frame_path(self, file_path, media_type):
+        # path to the cached png, decoding the file first if needed. None if it can't be decoded
+        try:
+            key = self.make_key(file_path)
+        except OSError:
+            return None
+
+        cached_path = self.lookup(key)
+        if cached_path is not None:
+            return cached_path
+
+        frame = self.decode_frame(file_path, media_type)
+        if frame is None:
+            return None
+        return self.store(key, file_path, frame)
+
+    def get_cached(self, file_path, variant, decode):
+        try:
+            key = self.make_key(file_path, variant)
+        except OSError:
+            return None
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            loading = future is None
+            if loading:
+                future = concurrent.futures.Future()
+                self.in_flight[key] = future
+        if not loading:
+            return future.result()
+
+        try:
+            frame = self.load(key, file_path, variant, decode)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(frame)
+            return frame
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def load(self, key, file_path, variant, decode):
+        cached_path = self.lookup(key)
+        if cached_path is not None:
+            frame = cv2.imread(str(cached_path))
+            if frame is not None:
+                return frame
+
+        frame = decode()
+        if frame is None:
+            return None
+        self.store(key, file_path, frame, variant)
+        return frame
+
+    def get_frame(self, file_path, media_type):
+        # the frame itself, as a bgr array like cv2.imread gives
+        return self.get_cached(
+            file_path, "", lambda: self.decode_frame(file_path, media_type)
+        )
+
+    def get_video_samples(self, file_path, samples, thumbnail_size, duration=None):
+        # samples thumbnails stacked top to bottom, see decode_video_samples
+        return self.get_cached(
+            file_path,
+            f"samples={samples},size={thumbnail_size}",
+            lambda: self.decode_video_samples(
+                file_path, samples, thumbnail_size, duration
+            ),
+        )
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disconnect()
@@ -0,0 +1,202 @@
+import sys
+import cv2
+import numpy as np
+
+# mse checks for is_frames_match, on whole frames at once instead of a python loop per patch
+# uint8 math wraps around (3 - 5 = 254) and made the old mse meaningless, sums here are done in wider ints
+#
+# videos are compared at a few timestamps across the whole video, at thumbnail size
+# images are compared block by block (a bad crop or watermark in one corner should still fail),
+# coarse to fine: averaging pixels smooths differences out, so a block that's over the threshold
+# at a lower resolution is over it at full resolution too, and we can stop there
+# (only once the uint8 rounding of the smaller frames is allowed for, see pyramid_block_mse.
+# python frame_compare.py checks that on generated frames)
+
+PATCH_SIZE = 128
+PYRAMID_LEVELS = 2
+MIN_PYRAMID_PATCH_SIZE = 16
+
+
+def align_frames(frame1, frame2):
+    # scale the first frame to the second's size, once, instead of per patch
+    if frame1.shape[:2] != frame2.shape[:2]:
+        frame1 = cv2.resize(
+            frame1, frame2.shape[:2][::-1], interpolation=cv2.INTER_AREA
+        )
+    if frame1.ndim != frame2.ndim:
+        if frame1.ndim == 2:
+            frame1 = cv2.cvtColor(frame1, cv2.COLOR_GRAY2BGR)
+        else:
+            frame2 = cv2.cvtColor(frame2, cv2.COLOR_GRAY2BGR)
+    return frame1, frame2
+
+
+def squared_difference(frame1, frame2, margin=0):
+    # absdiff is exact on uint8 and every square fits in a uint16, no float copies of the frames needed
+    # margin is taken off every difference first (never going below 0), see pyramid_block_mse
+    difference = cv2.absdiff(frame1, frame2)
+    if margin:
+        difference = cv2.subtract(difference, (margin,) * 4)  # saturates at 0
+    return np.square(difference, dtype=np.uint16)
+
+
+def frame_mse(frame1, frame2):
+    frame1, frame2 = align_frames(frame1, frame2)
+    return float(np.mean(squared_difference(frame1, frame2)))
+
+
+def cell_counts(length, cell_size):
+    # pixels in each cell along one axis, the last cell is smaller when length isn't a multiple
+    return np.diff(np.append(np.arange(0, length, cell_size), length))
+
+
+def block_sums(squared, patch_size):
+    # (rows, columns) array with the sum of every patch_size x patch_size block, edge blocks can be smaller
+    height, width = squared.shape[:2]
+    channels = squared.shape[2] if squared.ndim == 3 else 1
+    squared = squared.reshape(height, width * channels)
+
+    # all the full height block rows in one reshape and reduce, then whatever rows are left over
+    full_height = height - height % patch_size
+    row_sums = squared[:full_height].reshape(-1, patch_size, width * channels)
+    row_sums = row_sums.sum(axis=1, dtype=np.uint32)
+    if full_height < height:
+        leftover = squared[full_height:].sum(axis=0, dtype=np.uint32)
+        row_sums = np.vstack([row_sums, leftover[None]])
+
+    column_starts = np.arange(0, width, patch_size)
+    return np.add.reduceat(row_sums, column_starts * channels, axis=1, dtype=np.uint64)
+
+
+def block_mse(frame1, frame2, patch_size):
+    # (rows, columns) array with the mse of every patch_size x patch_size block, edge blocks can be smaller
+    squared = squared_difference(frame1, frame2)
+    height, width = squared.shape[:2]
+    channels = squared.shape[2] if squared.ndim == 3 else 1
+    counts = np.outer(cell_counts(height, patch_size), cell_counts(width, patch_size))
+    return block_sums(squared, patch_size) / (counts * channels)
+
+
+def build_pyramid(frame1, frame2, patch_size=PATCH_SIZE, levels=PYRAMID_LEVELS):
+    # [(frame1, frame2, cell size, margin), ...], finest first, full resolution isn't included
+    # every level halves the one before it exactly (an odd row or column at the edge is cropped off first),
+    # so each pixel is the mean of the cell_size x cell_size full resolution pixels under it
+    # the mean is rounded back to uint8 at every level, each rounding moves it by at most 0.5, so a
+    # difference between the two frames is at most margin away from the exact mean difference
+    height, width = frame1.shape[:2]
+    if min(height, width) < 2 * patch_size:
+        return []
+
+    pyramid = []
+    cell_size = 1
+    for level in range(1, levels + 1):
+        if patch_size // (cell_size * 2) < MIN_PYRAMID_PATCH_SIZE:
+            break
+
+        rows, columns = frame1.shape[0] // 2, frame1.shape[1] // 2
+        frame1, frame2 = [
+            cv2.resize(
+                frame[: rows * 2, : columns * 2],
+                (columns, rows),
+                interpolation=cv2.INTER_AREA,
+            )
+            for frame in (frame1, frame2)
+        ]
+        cell_size *= 2
+        pyramid.append((frame1, frame2, cell_size, level))
+    return pyramid
+
+
+def pyramid_block_mse(frame1, frame2, cell_size, margin, height, width, patch_size):
+    # block_mse of the full resolution blocks, worked out from one pyramid level
+    # a cell counts as its difference minus margin, squared, times its pixels. the exact mean difference
+    # is at least that big, and a mean squared is never more than the mean of the squares, so this is
+    # never more than the full resolution block_mse and a block over the threshold here is over it there
+    # cells cropped off at the edge count as 0, which keeps that true
+    squared = squared_difference(frame1, frame2, margin)
+    channels = squared.shape[2] if squared.ndim == 3 else 1
+    level_sums = block_sums(squared, patch_size // cell_size)
+
+    counts = np.outer(cell_counts(height, patch_size), cell_counts(width, patch_size))
+    sums = np.zeros(counts.shape)
+    sums[: level_sums.shape[0], : level_sums.shape[1]] = level_sums * (
+        cell_size * cell_size
+    )
+    return sums / (counts * channels)
+
+
+def is_image_match(frame1, frame2, threshold, patch_size=PATCH_SIZE):
+    frame1, frame2 = align_frames(frame1, frame2)
+    height, width = frame1.shape[:2]
+
+    # coarsest first, only a match all the way down to full resolution counts
+    for level_frame1, level_frame2, cell_size, margin in reversed(
+        build_pyramid(frame1, frame2, patch_size)
+    ):
+        level_mse = pyramid_block_mse(
+            level_frame1, level_frame2, cell_size, margin, height, width, patch_size
+        )
+        if level_mse.max() > threshold:
+            return False
+    return block_mse(frame1, frame2, patch_size).max() <= threshold
+
+
+def is_video_match(samples1, samples2, samples, threshold):
+    # samples1/samples2 are samples thumbnails stacked top to bottom (FrameCache.get_video_samples)
+    # every timestamp has to match, so a shared black intro frame can't carry a whole video
+    return all(
+        frame_mse(thumbnail1, thumbnail2) <= threshold
+        for thumbnail1, thumbnail2 in zip(
+            np.array_split(samples1, samples), np.array_split(samples2, samples)
+        )
+    )
+
+
+def fixture_pairs(count=200, seed=0):
+    # frames and slightly changed copies, odd sizes, gray and color, noise and flat areas
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        height, width = rng.integers(2 * PATCH_SIZE, 700, size=2)
+        shape = (height, width, 3) if i % 2 else (height, width)
+        if i % 3 == 0:
+            frame1 = np.full(shape, rng.integers(0, 256), dtype=np.uint8)
+        else:
+            frame1 = rng.integers(0, 256, size=shape, dtype=np.uint8)
+        if i % 4 == 2:
+            # sparse +1s, the cell means land on halves and quarters, where rounding bites
+            noise = rng.random(size=shape) < 0.5
+        else:
+            spread = int(rng.integers(1, 16))
+            noise = rng.integers(-spread, spread + 1, size=shape)
+        frame2 = np.clip(frame1.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        yield frame1, frame2
+
+
+def main():
+    # python frame_compare.py
+    # checks every pyramid level stays at or below the full resolution block mse, so the early exit
+    # never turns a full resolution match into a mismatch
+    failures = 0
+    pairs = 0
+    for frame1, frame2 in fixture_pairs():
+        pairs += 1
+        height, width = frame1.shape[:2]
+        full = block_mse(frame1, frame2, PATCH_SIZE)
+        for level_frame1, level_frame2, cell_size, margin in build_pyramid(
+            frame1, frame2
+        ):
+            level_mse = pyramid_block_mse(
+                level_frame1, level_frame2, cell_size, margin, height, width, PATCH_SIZE
+            )
+            if (level_mse > full).any():
+                failures += 1
+        if not is_image_match(frame1, frame2, full.max()):
+            failures += 1
+
+    print(f"Checked {pairs} frame pairs, {failures} failures.")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import concurrent.futures
+
+from phash_index import phash_to_int
+
+
+# blocked all-pairs hamming distance for phashes packed into uint64 arrays
+# each tile is block_size x block_size, so memory stays bounded no matter how many phashes we have
+# everything here is top-level functions on plain arrays, so it works from thread and process pools
+
+DEFAULT_BLOCK_SIZE = 1024
+
+
+if hasattr(np, "bitwise_count"):
+
+    def popcount64(values):
+        return np.bitwise_count(values)
+
+else:
+    # older numpy, count bits a byte at a time with a lookup table
+    _BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount64(values):
+        values = np.ascontiguousarray(values, dtype=np.uint64)
+        byte_counts = _BYTE_POPCOUNT[values.view(np.uint8)]
+        return byte_counts.reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def pack_phashes(phashes):
+    # phashes can be hex strings from our database or ints from stash
+    return np.fromiter(
+        (phash_to_int(phash) for phash in phashes), dtype=np.uint64, count=len(phashes)
+    )
+
+
+def hamming_block(a, b):
+    # (len(a), len(b)) matrix of distances
+    return popcount64(np.bitwise_xor(a[:, None], b[None, :])).astype(np.uint8)
+
+
+def find_pairs_in_tile(a, b, a_offset, b_offset, max_distance):
+    distances = hamming_block(a, b)
+    within = distances <= max_distance
+
+    # tiles on the diagonal compare a block with itself, keep only i < j
+    if a_offset == b_offset:
+        within &= np.triu(np.ones(within.shape, dtype=bool), k=1)
+
+    left, right = np.nonzero(within)
+    return (
+        left.astype(np.int64) + a_offset,
+        right.astype(np.int64) + b_offset,
+        distances[left, right],
+    )
+
+
+def iter_tiles(count, block_size):
+    # upper triangle of tiles only, (i, j) and (j, i) are the same pairs
+    for a_start in range(0, count, block_size):
+        for b_start in range(a_start, count, block_size):
+            yield a_start, b_start
+
+
+def find_close_pairs(
+    hashes, max_distance, block_size=DEFAULT_BLOCK_SIZE, executor=None
+):
+    # returns (left, right, distance) arrays for every pair with left < right and distance <= max_distance
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    count = len(hashes)
+
+    def tile_args(a_start, b_start):
+        return (
+            hashes[a_start : a_start + block_size],
+            hashes[b_start : b_start + block_size],
+            a_start,
+            b_start,
+            max_distance,
+        )
+
+    if executor is None:
+        results = [
+            find_pairs_in_tile(*tile_args(a_start, b_start))
+            for a_start, b_start in iter_tiles(count, block_size)
+        ]
+    else:
+        futures = [
+            executor.submit(find_pairs_in_tile, *tile_args(a_start, b_start))
+            for a_start, b_start in iter_tiles(count, block_size)
+        ]
+        results = [future.result() for future in futures]
+
+    if not results:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.uint8)
+
+    left = np.concatenate([result[0] for result in results])
+    right = np.concatenate([result[1] for result in results])
+    distances = np.concatenate([result[2] for result in results])
+    return left, right, distances
+
+
+class BlockedHammingIndex:
+    # brute force, but vectorized, for smaller collections
+    # matches the add/search interface of the bk-tree and multi-index hashing, so group_near_duplicates can use it
+    # all pairs are computed once on the first search, every search after that is a dict lookup
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, workers=None):
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.values = {}
+        self.neighbors = None
+        self.max_distance = None
+
+    def add(self, value):
+        if value not in self.values:
+            self.values[value] = len(self.values)
+            self.neighbors = None
+
+    def build_neighbors(self, max_distance):
+        values = list(self.values)
+        hashes = np.array(values, dtype=np.uint64)
+
+        # numpy releases the gil for the xor and popcount, so threads are enough here
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            left, right, distances = find_close_pairs(
+                hashes, max_distance, block_size=self.block_size, executor=executor
+            )
+
+        self.neighbors = {value: [(0, value)] for value in values}
+        for i, j, distance in zip(left.tolist(), right.tolist(), distances.tolist()):
+            self.neighbors[values[i]].append((distance, values[j]))
+            self.neighbors[values[j]].append((distance, values[i]))
+        self.max_distance = max_distance
+
+    def search(self, value, max_distance):
+        if self.neighbors is None or self.max_distance != max_distance:
+            self.build_neighbors(max_distance)
+        return list(self.neighbors.get(value, []))
+
+    def __len__(self):
+        return len(self.values)
@@ -1,120 +1,631 @@
+import os
 import csv
+import time
+import queue
+import random
 import sqlite3
+import argparse
 import imagehash
+import itertools
+import numpy as np
+import threading
+import multiprocessing
+import multiprocessing.connection
 import concurrent.futures
 
 from PIL import Image
 from tqdm import tqdm
 from pathlib import Path
 
+from build_db import migrate_database
+from phash_index import phash_to_signed, phash_to_hex
+from phash_kernel import phash_pixels, batch_phash
+from video_phash import hash_video
+from phash_checkpoint import PhashCheckpoint, CHECKPOINT_BATCH_SIZE
+from phash_checkpoint import attach_checkpoint, cache_staged_phashes
+from phash_checkpoint import rehydrate_database, rehydrate_phashes, evict_cache
 from user_config import phashes_path
 from user_config import database_path
 from user_config import processed_images_path
+from user_config import phash_checkpoint_path, phash_cache_max_entries
+from user_config import phash_workers, phash_chunk_size, fast_phash_decode
+from user_config import video_phash_timeout
+
+parser = argparse.ArgumentParser(description="Generate phashes for images and videos")
+parser.add_argument(
+    "--workers", type=int, help="Override value for phash_workers (0 = all cores)"
+)
+parser.add_argument(
+    "--chunk-size", type=int, help="Override value for phash_chunk_size"
+)
+parser.add_argument(
+    "--use-threads",
+    action="store_true",
+    help="Hash with threads instead of processes (the old behaviour)",
+)
+parser.add_argument(
+    "--retry-failed",
+    action="store_true",
+    help="Also retry images that failed to hash in a previous run",
+)
+parser.add_argument(
+    "--merge-only",
+    action="store_true",
+    help="Skip hashing, just merge the checkpoint's phashes into the database",
+)
+parser.add_argument(
+    "--merge-csv",
+    type=Path,
+    metavar="CSV_PATH",
+    help="Merge a file_id,phash csv into the database instead of the checkpoint, then exit",
+)
+parser.add_argument(
+    "--fast-decode",
+    action="store_true",
+    help="Override value for fast_phash_decode",
+)
+parser.add_argument(
+    "--validate-fast-decode",
+    type=int,
+    metavar="SAMPLE_SIZE",
+    help="Compare fast and full decode phashes on a random sample of images, then exit",
+)
+parser.add_argument(
+    "--videos",
+    action="store_true",
+    help="Hash videos stash hasn't generated a phash for, instead of images",
+)
+parser.add_argument(
+    "--video-timeout",
+    type=int,
+    help="Override value for video_phash_timeout",
+)
+
+# fast decode never goes below this many pixels on the short side, phash only needs 32x32
+# but decoding a little bigger keeps the lanczos resize (and so the hash) close to a full decode
+FAST_DECODE_MIN_SIZE = 256
+
+# at most this many chunks per worker are submitted but not finished yet, so the work list,
+# futures and results stay bounded no matter how big the library is
+PENDING_CHUNKS_PER_WORKER = 4
+READ_BATCH_SIZE = 1000
+
+# how many bits a fast decode phash can differ from a full decode phash before --validate-fast-decode
+# reports it. this is a chosen default, not a measured bound, run --validate-fast-decode on your own library
+FAST_DECODE_TOLERANCE = 2
+
+# how often the video supervisor checks for finished, crashed and timed out workers
+VIDEO_POLL_INTERVAL = 0.5
+
+
+def open_reduced_image(image_path, min_size=FAST_DECODE_MIN_SIZE):
+    image = Image.open(image_path)
+
+    if image.format == "JPEG":
+        # jpegs can be scaled down while decoding (1/2, 1/4, 1/8 in the dct domain)
+        # draft picks the smallest scale that's still at least min_size
+        image.draft("L", (min_size, min_size))
+        return image
+
+    # everything else has to be decoded in full, but reducing first makes the resize much cheaper
+    image = image.convert("L")
+    factor = min(image.size) // min_size
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+
+def hash_image(image_path, fast_decode=False):
+    if fast_decode:
+        image = open_reduced_image(image_path)
+    else:
+        image = Image.open(image_path)
+    return imagehash.phash(image)
 
 
-def calculate_phash(image_path):
+def calculate_phash(image_path, fast_decode=False):
     try:
-        image = Image.open(image_path)
-        phash = imagehash.phash(image)
-        return phash
+        return hash_image(image_path, fast_decode)
     except Exception as e:
         tqdm.write(f"Failed to process {image_path}")
         tqdm.write(f"Error: {e}\n")
         return None
 
 
-def fetch_image_data(database_path, processed_images_path):
+# skip everything the checkpoint already has, failures too unless we're retrying them
+# content we've hashed before was already filled in from the cache (phash IS NOT NULL),
+# and copies of the same content are only hashed once, the rest get it from the cache after the merge
+PENDING_IMAGES_QUERY = """
+    SELECT MIN(file_id), file_path FROM files
+    WHERE media_type = 'image' AND md5 IS NOT NULL AND phash IS NULL
+    AND file_id NOT IN (
+        SELECT file_id FROM checkpoint.image_phashes
+        WHERE status = 'ok' OR NOT ?
+    )
+    GROUP BY md5
+"""
+
+# videos stash hasn't fingerprinted, most have no md5 so every file is hashed on its own
+PENDING_VIDEOS_QUERY = """
+    SELECT file_id, file_path, duration FROM files
+    WHERE media_type = 'video' AND phash IS NULL
+    AND file_id NOT IN (
+        SELECT file_id FROM checkpoint.image_phashes
+        WHERE status = 'ok' OR NOT ?
+    )
+"""
+
+
+def count_image_data(
+    database_path, checkpoint_path, retry_failed=False, query=PENDING_IMAGES_QUERY
+):
     conn = sqlite3.connect(database_path)
     cursor = conn.cursor()
 
-    cursor.execute(
-        "SELECT file_id, file_path FROM files WHERE md5 IS NOT NULL AND phash IS NULL"
-    )
-    results = cursor.fetchall()
+    cursor.execute("ATTACH DATABASE ? AS checkpoint", (str(checkpoint_path),))
+    cursor.execute(f"SELECT COUNT(*) FROM ({query})", (retry_failed,))
+    count = cursor.fetchone()[0]
 
-    processed_data = set()
-    if Path(processed_images_path).is_file():
-        with open(processed_images_path, "r") as processed_file:
-            for line in processed_file:
-                file_id = line.strip()
-                processed_data.add(file_id)
+    conn.close()
 
-    filtered_results = [row for row in results if str(row[0]) not in processed_data]
+    return count
 
-    conn.close()
 
-    return filtered_results
+def fetch_image_data(
+    database_path, checkpoint_path, retry_failed=False, query=PENDING_IMAGES_QUERY
+):
+    # a generator, rows are read in batches so the work list never sits in memory
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
 
+    try:
+        cursor.execute("ATTACH DATABASE ? AS checkpoint", (str(checkpoint_path),))
+        cursor.execute(query, (retry_failed,))
+        while True:
+            rows = cursor.fetchmany(READ_BATCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+
+def process_image_chunk(rows, fast_decode=False):
+    # runs in a worker process, a chunk at a time so we don't pay pickling overhead per image
+    # images are decoded and shrunk one by one, then the whole chunk is hashed in one batch
+    # results are (file_id, phash, error), phash is a hex str so it's cheap to send back
+    results = []
+    file_ids = []
+    pixels = []
+    try:
+        for file_id, file_path in rows:
+            try:
+                if fast_decode:
+                    image = open_reduced_image(file_path)
+                else:
+                    image = Image.open(file_path)
+                pixels.append(phash_pixels(image))
+                file_ids.append(file_id)
+            except Exception as e:
+                tqdm.write(f"Failed to process {file_path}")
+                tqdm.write(f"Error: {e}\n")
+                results.append((file_id, None, str(e)))
+    except KeyboardInterrupt:
+        pass
+
+    if pixels:
+        hashes = batch_phash(np.stack(pixels))
+        for file_id, phash in zip(file_ids, hashes.tolist()):
+            results.append((file_id, phash_to_hex(phash), None))
+
+    return results
+
+
+def chunk_rows(rows, chunk_size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def checkpoint_writer(results_queue, checkpoint_path, progress_bar):
+    # the only thing that writes results, batched so it's one transaction per CHECKPOINT_BATCH_SIZE images
+    # the connection is opened here, sqlite connections have to stay on the thread that made them
+    with PhashCheckpoint(checkpoint_path) as checkpoint:
+        pending_results = []
+        while True:
+            results = results_queue.get()
+            if results is None:
+                break
+
+            pending_results.extend(results)
+            progress_bar.update(len(results))
+
+            if len(pending_results) >= CHECKPOINT_BATCH_SIZE:
+                checkpoint.record_results(pending_results)
+                pending_results = []
+
+        checkpoint.record_results(pending_results)
+
+
+def hash_images(
+    image_data, executor, max_pending, chunk_size, fast_decode, progress_bar
+):
+    # reader (this thread) -> bounded set of in-flight chunks (workers) -> results queue -> writer thread
+    # when max_pending chunks are in flight, we wait for one to finish before reading more
+    results_queue = queue.Queue(maxsize=max_pending)
+    writer = threading.Thread(
+        target=checkpoint_writer,
+        args=(results_queue, phash_checkpoint_path, progress_bar),
+    )
+    writer.start()
 
-def process_image(row, processed_images_path):
+    pending = set()
     try:
-        file_id = row[0]
-        file_path = row[1]
-        phash = calculate_phash(file_path)
+        for chunk in chunk_rows(image_data, chunk_size):
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    results_queue.put(future.result())
+
+            pending.add(executor.submit(process_image_chunk, chunk, fast_decode))
+
+        for future in concurrent.futures.as_completed(pending):
+            results_queue.put(future.result())
+        pending = set()
+    finally:
+        for future in pending:
+            future.cancel()
+
+        # the writer flushes whatever it already has before exiting, even on ctrl-c
+        results_queue.put(None)
+        writer.join()
+
+
+def process_video(row, connection):
+    # runs in its own process, so a video that hangs the decoder can be killed without taking anything else down
+    file_id, file_path, duration = row
+    try:
+        connection.send((phash_to_hex(hash_video(file_path, duration)), None))
+    except Exception as e:
+        connection.send((None, str(e)))
+    finally:
+        connection.close()
+
+
+def hash_videos(video_data, workers, timeout, progress_bar):
+    # a process per video, at most workers at a time, each one killed if it runs past timeout
+    # a pool can't do that, a stuck task takes its worker with it and there's no way to cancel it
+    # every process gets its own pipe, so killing one can never leave a shared queue locked
+    # results go through the same writer thread as images
+    results_queue = queue.Queue(maxsize=workers * PENDING_CHUNKS_PER_WORKER)
+    writer = threading.Thread(
+        target=checkpoint_writer,
+        args=(results_queue, phash_checkpoint_path, progress_bar),
+    )
+    writer.start()
+
+    running = {}  # connection -> (process, file_id, file_path, start time)
+
+    def finish(connection, phash, error):
+        process, file_id, file_path, _ = running.pop(connection)
+        process.kill()
+        process.join()
+        connection.close()
+        if error is not None:
+            tqdm.write(f"Failed to process {file_path}")
+            tqdm.write(f"Error: {error}\n")
+        results_queue.put([(file_id, phash, error)])
+
+    video_data = iter(video_data)
+    exhausted = False
+    try:
+        while running or not exhausted:
+            while not exhausted and len(running) < workers:
+                row = next(video_data, None)
+                if row is None:
+                    exhausted = True
+                    break
+                connection, child_connection = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=process_video, args=(row, child_connection), daemon=True
+                )
+                process.start()
+                # our copy has to be closed, otherwise a crashed worker never shows up as EOF
+                child_connection.close()
+                running[connection] = (process, row[0], row[1], time.time())
+
+            for connection in multiprocessing.connection.wait(
+                list(running), timeout=VIDEO_POLL_INTERVAL
+            ):
+                try:
+                    phash, error = connection.recv()
+                except EOFError:
+                    # crashed inside the decoder, before it could send anything back
+                    process = running[connection][0]
+                    process.join()
+                    phash, error = None, f"worker crashed (exit code {process.exitcode})"
+                finish(connection, phash, error)
+
+            now = time.time()
+            for connection, (_, _, _, started) in list(running.items()):
+                if now - started > timeout:
+                    finish(connection, None, f"timed out after {timeout} seconds")
+    finally:
+        for connection in list(running):
+            process = running.pop(connection)[0]
+            process.kill()
+            process.join()
+            connection.close()
+
+        # the writer flushes whatever it already has before exiting, even on ctrl-c
+        results_queue.put(None)
+        writer.join()
+
+
+def iter_csv_phashes(csv_path):
+    # streamed, so big csvs never have to fit in memory
+    with open(csv_path, "r") as csv_file:
+        for row in csv.reader(csv_file):
+            if len(row) < 2 or not row[0].isdigit():
+                continue
+            try:
+                yield int(row[0]), phash_to_signed(row[1])
+            except ValueError:
+                continue
 
-        with open(processed_images_path, "a") as processed_file:
-            processed_file.write(f"{file_id}\n")
 
-        return file_id, phash
-    except KeyboardInterrupt:
-        return None
+def merge_staged_phashes(cursor):
+    # matched: file exists and has no phash yet, so it gets ours
+    # unchanged: file already has the same phash
+    # conflicting: file already has a different phash, we leave it alone
+    # skipped: file isn't in the database anymore
+    cursor.execute(
+        """
+        SELECT
+            COUNT(*),
+            COALESCE(SUM(f.file_id IS NOT NULL AND f.phash IS NULL), 0),
+            COALESCE(SUM(f.phash = s.phash), 0),
+            COALESCE(SUM(f.phash != s.phash), 0),
+            COALESCE(SUM(f.file_id IS NULL), 0)
+        FROM temp.staged_phashes s
+        LEFT JOIN files f ON f.file_id = s.file_id
+    """
+    )
+    staged, matched, unchanged, conflicting, skipped = cursor.fetchone()
+
+    if sqlite3.sqlite_version_info >= (3, 33, 0):
+        cursor.execute(
+            """
+            UPDATE files SET phash = s.phash
+            FROM temp.staged_phashes s
+            WHERE files.file_id = s.file_id AND files.phash IS NULL
+        """
+        )
+    else:
+        # no UPDATE ... FROM before sqlite 3.33
+        cursor.execute(
+            """
+            UPDATE files SET phash = (
+                SELECT s.phash FROM temp.staged_phashes s WHERE s.file_id = files.file_id
+            )
+            WHERE phash IS NULL
+            AND file_id IN (SELECT file_id FROM temp.staged_phashes)
+        """
+        )
+
+    print(f"Staged: {staged}")
+    print(f"Matched: {matched}")
+    print(f"Unchanged: {unchanged}")
+    print(f"Conflicting: {conflicting}")
+    print(f"Skipped: {skipped}")
+
 
+def update_database_with_phash(csv_path=None):
+    start_time = time.time()
 
-def update_database_with_phash():
     conn = sqlite3.connect(database_path)
     cursor = conn.cursor()
 
-    with open(phashes_path, "r") as csv_file:
-        csv_reader = csv.reader(csv_file)
-        rows = list(csv_reader)
+    # attach before anything writes, sqlite can't attach inside a transaction
+    attach_checkpoint(cursor, phash_checkpoint_path)
+
+    cursor.execute(
+        "CREATE TEMP TABLE staged_phashes (file_id INTEGER PRIMARY KEY, phash INTEGER NOT NULL)"
+    )
 
-        total_rows = len(rows) - 1
-        print(f"Found {total_rows} rows in {phashes_path}")
+    # staging and the merge happen in a single transaction
+    if csv_path is None:
+        print(f"Staging phashes from {phash_checkpoint_path}")
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO temp.staged_phashes (file_id, phash)
+            SELECT file_id, phash FROM checkpoint.image_phashes
+            WHERE status = 'ok' AND phash IS NOT NULL
+        """
+        )
+    else:
+        print(f"Staging phashes from {csv_path}")
+        cursor.executemany(
+            "INSERT OR REPLACE INTO temp.staged_phashes (file_id, phash) VALUES (?, ?)",
+            iter_csv_phashes(csv_path),
+        )
+
+    merge_staged_phashes(cursor)
+
+    # remember what we merged by content, then hand it to any copies of the same content
+    cached = cache_staged_phashes(cursor)
+    rehydrated = rehydrate_phashes(cursor)
+    evict_cache(cursor, phash_cache_max_entries)
+    print(f"Cached: {cached}")
+    print(f"Copied to identical files: {rehydrated}")
 
-        for row in rows[1:]:
-            file_id = row[0]
-            phash = row[1]
+    conn.commit()
+    conn.close()
 
-            if not phash:
-                continue
+    print(f"Merged in {time.time() - start_time:.2f} seconds.")
 
-            cursor.execute(
-                "UPDATE files SET phash = ? WHERE file_id = ? AND (phash IS NULL OR phash = '')",
-                (phash, file_id),
-            )
 
-    conn.commit()
+def validate_fast_decode(database_path, sample_size):
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT file_path FROM files WHERE media_type = 'image' AND file_path IS NOT NULL"
+    )
+    image_paths = [row[0] for row in cursor.fetchall()]
     conn.close()
 
+    sample = random.sample(image_paths, min(sample_size, len(image_paths)))
+    print(f"Comparing fast and full decode phashes on {len(sample)} images.\n")
+
+    distances = []
+    full_time = 0
+    fast_time = 0
+    for image_path in tqdm(sample):
+        start_time = time.time()
+        full_phash = calculate_phash(image_path)
+        full_time += time.time() - start_time
+
+        start_time = time.time()
+        fast_phash = calculate_phash(image_path, fast_decode=True)
+        fast_time += time.time() - start_time
+
+        if full_phash is None or fast_phash is None:
+            continue
+
+        distance = full_phash - fast_phash
+        distances.append(distance)
+        if distance > FAST_DECODE_TOLERANCE:
+            tqdm.write(f"{distance} bits off: {image_path}")
+
+    if not distances:
+        print("No images could be hashed.")
+        return
+
+    print()
+    for distance in sorted(set(distances)):
+        print(f"{distance} bits: {distances.count(distance)} images")
+    print()
+    print(f"Max distance: {max(distances)} (tolerance {FAST_DECODE_TOLERANCE})")
+    print(f"Mean distance: {sum(distances) / len(distances):.2f}")
+    if fast_time > 0:
+        print(f"Speedup: {full_time / fast_time:.2f}x")
+
+
+def hash_video_files(args, workers):
+    timeout = args.video_timeout or video_phash_timeout
+
+    total_videos = count_image_data(
+        database_path,
+        phash_checkpoint_path,
+        retry_failed=args.retry_failed,
+        query=PENDING_VIDEOS_QUERY,
+    )
+    video_data = fetch_image_data(
+        database_path,
+        phash_checkpoint_path,
+        retry_failed=args.retry_failed,
+        query=PENDING_VIDEOS_QUERY,
+    )
+    progress_bar = tqdm(total=total_videos, unit="video")
+
+    start_time = time.time()
+    try:
+        hash_videos(video_data, workers, timeout, progress_bar)
+    except KeyboardInterrupt:
+        progress_bar.close()
+        print("Process interrupted. Everything hashed so far is in the checkpoint.")
+        return
+
+    elapsed = time.time() - start_time
+    if elapsed > 0:
+        tqdm.write(
+            f"Hashed {progress_bar.n} videos in {elapsed:.2f} seconds ({progress_bar.n / elapsed:.2f} videos/s)"
+        )
+
+    progress_bar.close()
+    print()
+
+    print("Updating database with phash values...")
+    update_database_with_phash()
+    print("Done.")
+
+    print()
+    input("Press Enter to exit...")
+
 
 def main():
-    image_data = fetch_image_data(database_path, processed_images_path)
-    progress_bar = tqdm(total=len(image_data))
-
-    with open(phashes_path, "a") as output_csv, concurrent.futures.ThreadPoolExecutor(
-        max_workers=3
-    ) as executor:
-        futures = []
-        try:
-            for row in image_data:
-                future = executor.submit(process_image, row, processed_images_path)
-                futures.append(future)
-
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                if result is not None:
-                    file_id, phash = result
-                    output_csv.write(f"{file_id},{phash}\n")
-                    output_csv.flush()
-                    progress_bar.update(1)
-                else:
-                    break
-        except KeyboardInterrupt:
-            for future in futures:
-                future.cancel()
-            progress_bar.close()
-            print("Process interrupted.")
-            return
+    args = parser.parse_args()
+    workers = args.workers or phash_workers or os.cpu_count() or 1
+    chunk_size = args.chunk_size or phash_chunk_size
+    fast_decode = args.fast_decode or fast_phash_decode
+
+    migrate_database(database_path)
+
+    if args.validate_fast_decode:
+        validate_fast_decode(database_path, args.validate_fast_decode)
+        return
+
+    if args.merge_csv:
+        update_database_with_phash(csv_path=args.merge_csv)
+        return
+
+    with PhashCheckpoint(phash_checkpoint_path) as checkpoint:
+        if checkpoint.is_empty():
+            checkpoint.import_legacy_files(phashes_path, processed_images_path)
+
+    rehydrate_database(database_path, phash_checkpoint_path, phash_cache_max_entries)
+
+    if args.merge_only:
+        update_database_with_phash()
+        return
+
+    if args.videos:
+        hash_video_files(args, workers)
+        return
+
+    total_images = count_image_data(
+        database_path, phash_checkpoint_path, retry_failed=args.retry_failed
+    )
+    image_data = fetch_image_data(
+        database_path, phash_checkpoint_path, retry_failed=args.retry_failed
+    )
+    progress_bar = tqdm(total=total_images, unit="img")
+
+    # imagehash's resize and dct hold the gil, so threads don't actually hash in parallel
+    # worker processes do, and results come back here so only this process writes to disk
+    if args.use_threads:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    start_time = time.time()
+    try:
+        hash_images(
+            image_data,
+            executor,
+            workers * PENDING_CHUNKS_PER_WORKER,
+            chunk_size,
+            fast_decode,
+            progress_bar,
+        )
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        progress_bar.close()
+        print("Process interrupted. Everything hashed so far is in the checkpoint.")
+        return
+
+    executor.shutdown()
+
+    elapsed = time.time() - start_time
+    if elapsed > 0:
+        tqdm.write(
+            f"Hashed {progress_bar.n} images in {elapsed:.2f} seconds ({progress_bar.n / elapsed:.1f} images/s)"
+        )
 
     progress_bar.close()
     print()
@@ -0,0 +1,120 @@
+import os
+import threading
+import concurrent.futures
+
+# works out frame match verdicts for the next few groups in the background,
+# so they're usually already waiting by the time remove_dupes.py asks about a file
+#
+# decoding happens in threads, opencv releases the gil while it decodes
+# every comparison reserves its estimated decode memory from a shared budget before it starts,
+# so lookahead never holds more than max_bytes of frames at once
+# verdicts that involve a file we've since deleted or moved are dropped, see invalidate
+
+# a 12 megapixel photo, for files we don't know the resolution of
+DEFAULT_FRAME_BYTES = 4000 * 3000 * 3
+
+
+def estimate_frame_bytes(entry):
+    if entry.get("width") and entry.get("height"):
+        return int(entry["width"]) * int(entry["height"]) * 3
+    return DEFAULT_FRAME_BYTES
+
+
+def estimate_comparison_bytes(entries):
+    # is_frames_match holds two frames at a time, the first file's and the one it's compared with
+    return 2 * max(estimate_frame_bytes(entry) for entry in entries)
+
+
+def normalize_path(file_path):
+    # remove_file gets a Path, the comparisons were submitted with the database's strings
+    return os.path.normcase(os.path.normpath(str(file_path)))
+
+
+class MemoryBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            # something bigger than the whole budget still runs, just on its own
+            while self.used and self.used + size > self.max_bytes:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class MatchPrefetcher:
+    def __init__(self, compute, workers, max_bytes):
+        self.compute = compute  # compute(file_paths, media_type) -> bool
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.budget = MemoryBudget(max_bytes)
+        self.futures = {}  # (file_paths, media_type) -> future
+        self.group_keys = {}  # group index -> keys it submitted
+        self.path_keys = {}  # normalized file path -> keys that compare it
+
+    def run(self, file_paths, media_type, size):
+        self.budget.acquire(size)
+        try:
+            return self.compute(list(file_paths), media_type)
+        finally:
+            self.budget.release(size)
+
+    def submit(self, group_index, comparisons):
+        # comparisons are (file_paths, media_type, estimated bytes)
+        keys = []
+        for file_paths, media_type, size in comparisons:
+            key = (tuple(file_paths), media_type)
+            keys.append(key)
+            if key not in self.futures:
+                self.futures[key] = self.executor.submit(
+                    self.run, key[0], media_type, size
+                )
+                for file_path in key[0]:
+                    path_key = normalize_path(file_path)
+                    self.path_keys.setdefault(path_key, set()).add(key)
+        self.group_keys[group_index] = keys
+
+    def is_submitted(self, group_index):
+        return group_index in self.group_keys
+
+    def result(self, file_paths, media_type):
+        # the verdict, waiting for it if it's still being worked out. None if it was never submitted
+        future = self.futures.get((tuple(file_paths), media_type))
+        if future is None:
+            return None
+        return future.result()
+
+    def release(self, group_index):
+        # done with a group, nothing will ask for its verdicts again
+        for key in self.group_keys.pop(group_index, []):
+            self.drop(key)
+
+    def invalidate(self, file_path):
+        # the file is gone, a verdict worked out while it was still there would be stale
+        # whoever asks again gets it computed fresh
+        for key in list(self.path_keys.get(normalize_path(file_path), ())):
+            self.drop(key)
+
+    def drop(self, key):
+        future = self.futures.pop(key, None)
+        if future is None:
+            return
+        future.cancel()
+        for file_path in key[0]:
+            keys = self.path_keys.get(normalize_path(file_path))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.path_keys[normalize_path(file_path)]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.futures = {}
+        self.group_keys = {}
+        self.path_keys = {}
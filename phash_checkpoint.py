@@ -0,0 +1,281 @@
+import csv
+import time
+import sqlite3
+
+from pathlib import Path
+from phash_index import phash_to_signed
+
+# keeps track of every image we've tried to hash, so runs can be resumed instantly
+# lives in its own sqlite file, so rebuilding stash_data.sqlite never loses it
+# WAL + batched transactions, so we're not opening/flushing files once per image
+#
+# it also keeps a content addressed cache (md5 -> phash, or oshash -> phash for files stash has no md5 for),
+# so moved/renamed files (new file_id) and rebuilds of stash_data.sqlite get their phashes back
+# without hashing the file again
+
+CHECKPOINT_BATCH_SIZE = 500
+
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+
+
+class PhashCheckpoint:
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.conn = None
+        self.cursor = None
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.checkpoint_path)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        self.create_table()
+
+    def disconnect(self):
+        self.conn.commit()
+        self.cursor.close()
+        self.conn.close()
+
+    def create_table(self):
+        self.cursor.execute(
+            """CREATE TABLE IF NOT EXISTS image_phashes (
+                file_id INTEGER PRIMARY KEY,
+                phash INTEGER,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self.cursor.execute(
+            """CREATE TABLE IF NOT EXISTS content_phashes (
+                md5 TEXT PRIMARY KEY,
+                ohash TEXT,
+                phash INTEGER NOT NULL,
+                last_seen REAL NOT NULL
+            )"""
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_content_phashes_ohash ON content_phashes (ohash)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_content_phashes_last_seen ON content_phashes (last_seen)"
+        )
+        # content that only has an oshash, most videos hashed with --videos
+        self.cursor.execute(
+            """CREATE TABLE IF NOT EXISTS ohash_phashes (
+                ohash TEXT PRIMARY KEY,
+                phash INTEGER NOT NULL,
+                last_seen REAL NOT NULL
+            )"""
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ohash_phashes_last_seen ON ohash_phashes (last_seen)"
+        )
+        self.conn.commit()
+
+    def is_empty(self):
+        self.cursor.execute("SELECT 1 FROM image_phashes LIMIT 1")
+        return self.cursor.fetchone() is None
+
+    def record_results(self, results):
+        # results are (file_id, phash, error), phash is hex (or None when it failed)
+        now = time.time()
+        rows = []
+        for file_id, phash, error in results:
+            if phash is not None:
+                rows.append((file_id, phash_to_signed(phash), STATUS_OK, None, now))
+            else:
+                rows.append((file_id, None, STATUS_FAILED, error, now))
+
+        self.cursor.executemany(
+            """
+            INSERT OR REPLACE INTO image_phashes (file_id, phash, status, error, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            rows,
+        )
+        self.conn.commit()
+
+    def import_legacy_files(self, phashes_path, processed_images_path):
+        # one time migration from phashes.csv + phashed_file_ids.txt
+        results = {}
+
+        if Path(processed_images_path).is_file():
+            with open(processed_images_path, "r") as processed_file:
+                for line in processed_file:
+                    file_id = line.strip()
+                    if file_id.isdigit():
+                        results[int(file_id)] = (
+                            None,
+                            f"no phash recorded in {Path(phashes_path).name}",
+                        )
+
+        if Path(phashes_path).is_file():
+            with open(phashes_path, "r") as csv_file:
+                for row in csv.reader(csv_file):
+                    if len(row) < 2 or not row[0].isdigit():
+                        continue
+                    try:
+                        phash_to_signed(row[1])
+                        results[int(row[0])] = (row[1], None)
+                    except ValueError:
+                        results[int(row[0])] = (None, "failed before checkpointing")
+
+        if results:
+            print(f"Importing {len(results)} phashes from the old csv/txt files.\n")
+            self.record_results(
+                (file_id, phash, error) for file_id, (phash, error) in results.items()
+            )
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disconnect()
+
+
+# everything below runs on a connection to stash_data.sqlite with the checkpoint attached as "checkpoint"
+
+
+def attach_checkpoint(cursor, checkpoint_path):
+    # opening it once makes sure the tables exist
+    with PhashCheckpoint(checkpoint_path):
+        pass
+    cursor.execute("ATTACH DATABASE ? AS checkpoint", (str(checkpoint_path),))
+
+
+def cache_staged_phashes(cursor):
+    # remember the content of every phash we just merged, only where the merge actually took
+    # keyed by md5 when stash has one, by oshash otherwise
+    now = time.time()
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO checkpoint.content_phashes (md5, ohash, phash, last_seen)
+        SELECT f.md5, f.ohash, s.phash, ?
+        FROM temp.staged_phashes s
+        JOIN files f ON f.file_id = s.file_id
+        WHERE f.md5 IS NOT NULL AND f.phash = s.phash
+    """,
+        (now,),
+    )
+    cached = cursor.rowcount
+
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO checkpoint.ohash_phashes (ohash, phash, last_seen)
+        SELECT f.ohash, s.phash, ?
+        FROM temp.staged_phashes s
+        JOIN files f ON f.file_id = s.file_id
+        WHERE f.md5 IS NULL AND f.ohash IS NOT NULL AND f.phash = s.phash
+    """,
+        (now,),
+    )
+    cached += cursor.rowcount
+
+    return cached
+
+
+def rehydrate_phashes(cursor):
+    # files with no phash get one from the cache, by md5, or by oshash when stash has no md5
+    cursor.execute(
+        """
+        UPDATE files SET phash = (
+            SELECT c.phash FROM checkpoint.content_phashes c WHERE c.md5 = files.md5
+        )
+        WHERE phash IS NULL
+        AND md5 IN (SELECT md5 FROM checkpoint.content_phashes)
+    """
+    )
+    rehydrated = cursor.rowcount
+
+    # oshash-only content was cached under its oshash, older md5 entries can still match by theirs
+    cursor.execute(
+        """
+        UPDATE files SET phash = COALESCE(
+            (SELECT o.phash FROM checkpoint.ohash_phashes o WHERE o.ohash = files.ohash),
+            (SELECT c.phash FROM checkpoint.content_phashes c WHERE c.ohash = files.ohash)
+        )
+        WHERE phash IS NULL AND md5 IS NULL
+        AND (
+            ohash IN (SELECT ohash FROM checkpoint.ohash_phashes)
+            OR ohash IN (SELECT ohash FROM checkpoint.content_phashes WHERE ohash IS NOT NULL)
+        )
+    """
+    )
+    rehydrated += cursor.rowcount
+
+    # anything still in the library counts as seen, eviction goes by this
+    now = time.time()
+    cursor.execute(
+        """
+        UPDATE checkpoint.content_phashes SET last_seen = ?
+        WHERE md5 IN (SELECT md5 FROM files WHERE md5 IS NOT NULL)
+    """,
+        (now,),
+    )
+    cursor.execute(
+        """
+        UPDATE checkpoint.ohash_phashes SET last_seen = ?
+        WHERE ohash IN (SELECT ohash FROM files WHERE ohash IS NOT NULL)
+    """,
+        (now,),
+    )
+
+    return rehydrated
+
+
+def evict_cache(cursor, max_entries):
+    # only content that's no longer in the library is evicted, least recently seen first
+    # max_entries covers both the md5 and the oshash entries
+    cursor.execute(
+        """
+        SELECT (SELECT COUNT(*) FROM checkpoint.content_phashes)
+        + (SELECT COUNT(*) FROM checkpoint.ohash_phashes)
+    """
+    )
+    excess = cursor.fetchone()[0] - max_entries
+    if excess <= 0:
+        return 0
+
+    cursor.execute(
+        """
+        SELECT 'md5', md5, last_seen FROM checkpoint.content_phashes
+        WHERE md5 NOT IN (SELECT md5 FROM files WHERE md5 IS NOT NULL)
+        UNION ALL
+        SELECT 'ohash', ohash, last_seen FROM checkpoint.ohash_phashes
+        WHERE ohash NOT IN (SELECT ohash FROM files WHERE ohash IS NOT NULL)
+        ORDER BY last_seen
+        LIMIT ?
+    """,
+        (excess,),
+    )
+    evicted = cursor.fetchall()
+
+    cursor.executemany(
+        "DELETE FROM checkpoint.content_phashes WHERE md5 = ?",
+        [(key,) for kind, key, _ in evicted if kind == "md5"],
+    )
+    cursor.executemany(
+        "DELETE FROM checkpoint.ohash_phashes WHERE ohash = ?",
+        [(key,) for kind, key, _ in evicted if kind == "ohash"],
+    )
+    return len(evicted)
+
+
+def rehydrate_database(database_path, checkpoint_path, max_entries):
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+
+    attach_checkpoint(cursor, checkpoint_path)
+    rehydrated = rehydrate_phashes(cursor)
+    evicted = evict_cache(cursor, max_entries)
+
+    conn.commit()
+    conn.close()
+
+    print(f"Restored {rehydrated} phashes from the phash cache.")
+    if evicted:
+        print(f"Evicted {evicted} deleted files from the phash cache.")
+    print()
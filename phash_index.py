@@ -0,0 +1,410 @@
+import numpy as np
+
+# helpers for grouping phashes that are close, but not exactly the same
+# phashes are 64 bit, so internally we work with unsigned ints and only use hex for display
+
+PHASH_BITS = 64
+PHASH_MASK = (1 << PHASH_BITS) - 1
+
+
+def phash_to_int(phash):
+    # stash and our database give us signed ints, blacklists and csvs give us hex strings
+    # hex from older databases can have a leading 1 on positive values, so we mask it back to 64 bits
+    if isinstance(phash, int):
+        return phash & PHASH_MASK
+    return int(phash, 16) & PHASH_MASK
+
+
+def phash_to_signed(phash):
+    # what we store in the database, sqlite integers are signed 64 bit, same as stash
+    value = phash_to_int(phash)
+    if value >= 1 << (PHASH_BITS - 1):
+        value -= 1 << PHASH_BITS
+    return value
+
+
+def phash_to_hex(phash):
+    # only for display and blacklisted_phashes.txt
+    return format(phash_to_int(phash), "016x")
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    # burkhard-keller tree over hamming distance
+    # each node is (value, {distance: child}), so a search only has to walk children whose
+    # edge distance is within max_distance of the query's distance to the node (triangle inequality)
+    def __init__(self, distance_func=hamming_distance):
+        self.distance_func = distance_func
+        self.root = None
+        self.size = 0
+
+    def add(self, value):
+        if self.root is None:
+            self.root = (value, {})
+            self.size = 1
+            return
+
+        node = self.root
+        while True:
+            node_value, children = node
+            distance = self.distance_func(value, node_value)
+
+            # already in the tree
+            if distance == 0:
+                return
+
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (value, {})
+                self.size += 1
+                return
+
+            node = child
+
+    def search(self, value, max_distance):
+        matches = []
+        if self.root is None:
+            return matches
+
+        # iterative, so deep trees don't hit the recursion limit
+        stack = [self.root]
+        while stack:
+            node_value, children = stack.pop()
+            distance = self.distance_func(value, node_value)
+
+            if distance <= max_distance:
+                matches.append((distance, node_value))
+
+            low = distance - max_distance
+            high = distance + max_distance
+            for child_distance, child in children.items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+
+        return matches
+
+    def __len__(self):
+        return self.size
+
+
+class MultiIndexHash:
+    # multi-index hashing, for libraries too big for the bk-tree
+    # the 64 bits are split into bands, and each band gets its own exact lookup table
+    # if two phashes are within max_distance, and there are more bands than max_distance,
+    # at least one band has to match exactly (pigeonhole), so only those collisions need a full check
+    def __init__(self, bands=4):
+        self.bands = bands
+
+        # split the bits as evenly as we can, the first bands get the leftovers
+        self.band_layout = []
+        shift = 0
+        for i in range(bands):
+            width = PHASH_BITS // bands + (1 if i < PHASH_BITS % bands else 0)
+            self.band_layout.append((shift, (1 << width) - 1))
+            shift += width
+
+        self.tables = [{} for _ in range(bands)]
+        self.values = set()
+
+        # stats, so we can see how much work the bands save vs brute force
+        self.queries = 0
+        self.band_candidates = [0] * bands
+        self.verified_candidates = 0
+
+    def add(self, value):
+        if value in self.values:
+            return
+
+        self.values.add(value)
+        for table, (shift, mask) in zip(self.tables, self.band_layout):
+            table.setdefault((value >> shift) & mask, []).append(value)
+
+    def search(self, value, max_distance):
+        self.queries += 1
+
+        candidates = set()
+        for i, (table, (shift, mask)) in enumerate(zip(self.tables, self.band_layout)):
+            bucket = table.get((value >> shift) & mask, ())
+            self.band_candidates[i] += len(bucket)
+            candidates.update(bucket)
+
+        self.verified_candidates += len(candidates)
+
+        matches = []
+        for candidate in candidates:
+            distance = hamming_distance(value, candidate)
+            if distance <= max_distance:
+                matches.append((distance, candidate))
+        return matches
+
+    def print_stats(self):
+        brute_force = self.queries * len(self.values)
+        print(f"Multi-index hashing with {self.bands} bands:")
+        for i, count in enumerate(self.band_candidates):
+            print(f"  Band {i}: {count} candidates")
+        print(f"  Verified {self.verified_candidates} candidates")
+        if brute_force:
+            print(
+                f"  Brute force would need {brute_force} comparisons "
+                f"({100 * (1 - self.verified_candidates / brute_force):.2f}% pruned)"
+            )
+        print()
+
+    def __len__(self):
+        return len(self.values)
+
+
+def build_index(index_type, max_distance, bands=None):
+    if index_type == "bktree":
+        return BKTree()
+
+    if index_type == "mih":
+        # we need more bands than max_distance, otherwise close matches can slip through every band
+        if not bands:
+            bands = max_distance + 1
+        elif bands <= max_distance:
+            print(
+                f"{bands} bands can miss matches at distance {max_distance}, using {max_distance + 1} bands instead."
+            )
+            bands = max_distance + 1
+        return MultiIndexHash(bands=min(bands, PHASH_BITS))
+
+    if index_type == "numpy":
+        # imported here, hamming_kernel needs phash_to_int from this module
+        from hamming_kernel import BlockedHammingIndex
+
+        return BlockedHammingIndex()
+
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+class UnionFind:
+    # disjoint sets over 0..size-1, union by size with path halving, so merging is near-linear
+    # members of a set are kept as a circular linked list in next_member,
+    # so we can walk a set without keeping a python set per group
+    #
+    # with hashes (a uint64 array, one phash per element) it also keeps what within_diameter needs:
+    # each set's radius (how far its furthest member is from its root),
+    # and the sets each set is already known to be too far from
+    def __init__(self, size, hashes=None):
+        self.parent = list(range(size))
+        self.set_size = [1] * size
+        self.next_member = list(range(size))
+        self.hashes = hashes
+        self.radius = [0] * size
+        self.rejected = {}  # root -> roots of sets that can't be merged into it
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return root_a
+
+        if self.set_size[root_a] < self.set_size[root_b]:
+            root_a, root_b = root_b, root_a
+
+        if self.hashes is not None:
+            self.absorb(root_a, root_b)
+
+        self.parent[root_b] = root_a
+        self.set_size[root_a] += self.set_size[root_b]
+
+        # splice the two circular member lists together
+        self.next_member[root_a], self.next_member[root_b] = (
+            self.next_member[root_b],
+            self.next_member[root_a],
+        )
+        return root_a
+
+    def absorb(self, root_a, root_b):
+        # root_b's set is about to become part of root_a's
+        from hamming_kernel import popcount64
+
+        # root_a's own members are already within its radius, only root_b's need measuring
+        distances = popcount64(
+            self.hashes[self.member_array(root_b)] ^ self.hashes[root_a]
+        )
+        self.radius[root_a] = max(self.radius[root_a], int(distances.max()))
+
+        # sets only grow, so the pair that kept root_b's set from merging with another set
+        # keeps the merged set from it too. root_b won't be a root again, so its entries move to root_a
+        rejected_b = self.rejected.pop(root_b, None)
+        if rejected_b:
+            rejected_b.discard(root_a)
+            for other in rejected_b:
+                self.rejected[other].discard(root_b)
+                self.rejected[other].add(root_a)
+            self.rejected.setdefault(root_a, set()).update(rejected_b)
+
+    def members(self, x):
+        start = x
+        yield x
+        x = self.next_member[x]
+        while x != start:
+            yield x
+            x = self.next_member[x]
+
+    def member_array(self, x):
+        return np.fromiter(
+            self.members(x), dtype=np.int64, count=self.set_size[self.find(x)]
+        )
+
+    def reject(self, root_a, root_b):
+        self.rejected.setdefault(root_a, set()).add(root_b)
+        self.rejected.setdefault(root_b, set()).add(root_a)
+        return False
+
+    def within_diameter(self, a, b, max_diameter, block_size=1024):
+        # would merging a's set with b's set keep every pair within max_diameter?
+        # needs hashes. cheapest answers first, the all-pairs check only runs when nothing else decides
+        from hamming_kernel import hamming_block
+
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_b in self.rejected.get(root_a, ()):
+            return False
+
+        # triangle inequality: the roots are a pair themselves, and no pair can be further apart
+        # than one radius, plus the distance between the roots, plus the other radius
+        between = hamming_distance(int(self.hashes[root_a]), int(self.hashes[root_b]))
+        if between > max_diameter:
+            return self.reject(root_a, root_b)
+        if self.radius[root_a] + between + self.radius[root_b] <= max_diameter:
+            return True
+
+        # every pair, a block of root_a's members at a time so the distance matrix stays small
+        hashes_a = self.hashes[self.member_array(root_a)]
+        hashes_b = self.hashes[self.member_array(root_b)]
+        for start in range(0, len(hashes_a), block_size):
+            if (
+                hamming_block(hashes_a[start : start + block_size], hashes_b).max()
+                > max_diameter
+            ):
+                return self.reject(root_a, root_b)
+        return True
+
+
+def cluster_seeded(seeds, index, max_distance):
+    # each group is a seed plus everything within max_distance of it that isn't grouped yet
+    # groups can't chain, but a file can end up in a different group than its closest match
+    grouped = set()
+    clusters = []
+    for seed in seeds:
+        if seed in grouped:
+            continue
+
+        cluster = []
+        for distance, value in sorted(index.search(seed, max_distance)):
+            if value not in grouped:
+                grouped.add(value)
+                cluster.append(value)
+        clusters.append(cluster)
+
+    return clusters
+
+
+def cluster_transitive(seeds, index, max_distance, max_diameter=None):
+    # union-find over every close pair, so A~B and B~C puts A, B and C in one group
+    # max_diameter stops chains from merging phashes that are too far apart,
+    # closest pairs are merged first so the tightest groups win
+    positions = {value: i for i, value in enumerate(seeds)}
+
+    left = []
+    right = []
+    distances = []
+    for i, value in enumerate(seeds):
+        for distance, match in index.search(value, max_distance):
+            j = positions.get(match)
+            if j is not None and i < j:
+                left.append(i)
+                right.append(j)
+                distances.append(distance)
+
+    if max_diameter is None:
+        clusters = UnionFind(len(seeds))
+    else:
+        # imported here, hamming_kernel needs phash_to_int from this module
+        from hamming_kernel import pack_phashes
+
+        clusters = UnionFind(len(seeds), hashes=pack_phashes(seeds))
+
+    for edge in sorted(range(len(distances)), key=distances.__getitem__):
+        a = left[edge]
+        b = right[edge]
+        if max_diameter is not None and clusters.find(a) != clusters.find(b):
+            if not clusters.within_diameter(a, b, max_diameter):
+                continue
+        clusters.union(a, b)
+
+    # collect in seed order, so the first value of each group is its biggest seed
+    groups = {}
+    for i, value in enumerate(seeds):
+        groups.setdefault(clusters.find(i), []).append(value)
+
+    return list(groups.values())
+
+
+def group_near_duplicates(
+    exact_groups,
+    max_distance,
+    index_type="bktree",
+    bands=None,
+    clustering="seed",
+    max_diameter=None,
+    index=None,
+):
+    # exact_groups is the {phash: [entry, ...]} dict from an exact group_by_phash
+    # pass in an index from build_index to read its stats afterwards, otherwise one is built here
+    # we return the same shape, where each group holds the phashes clustered together
+    # the first phash of a group is the key, and its entries come first, so group[0]["phash"] is always the key
+    values_to_phashes = {}
+    ungroupable = {}
+    for phash, group in exact_groups.items():
+        try:
+            value = phash_to_int(phash)
+        except (TypeError, ValueError):
+            ungroupable[phash] = group
+            continue
+        values_to_phashes.setdefault(value, []).append(phash)
+
+    if index is None:
+        index = build_index(index_type, max_distance, bands)
+    for value in values_to_phashes:
+        index.add(value)
+
+    # seed from the biggest exact groups first, so results don't depend on dict order
+    seeds = sorted(
+        values_to_phashes,
+        key=lambda value: (
+            -sum(len(exact_groups[phash]) for phash in values_to_phashes[value]),
+            value,
+        ),
+    )
+
+    if clustering == "transitive":
+        clusters = cluster_transitive(seeds, index, max_distance, max_diameter)
+    elif clustering == "seed":
+        clusters = cluster_seeded(seeds, index, max_distance)
+    else:
+        raise ValueError(f"Unknown clustering: {clustering}")
+
+    near_groups = {}
+    for cluster in clusters:
+        group = []
+        for value in cluster:
+            for phash in values_to_phashes[value]:
+                group.extend(exact_groups[phash])
+        near_groups[values_to_phashes[cluster[0]][0]] = group
+
+    near_groups.update(ungroupable)
+    return near_groups
@@ -0,0 +1,105 @@
+import sys
+import numpy as np
+import scipy.fftpack
+
+from PIL import Image
+from pathlib import Path
+
+from user_config import image_extensions
+
+# batched version of imagehash.phash
+# decoding and the 32x32 resize still happen per image (in the workers), but the dct, median and
+# bit packing run once for a whole N x 32 x 32 stack, instead of once per image in python
+# the bits match imagehash.phash exactly, run this file to check
+
+HASH_SIZE = 8
+HIGHFREQ_FACTOR = 4
+IMG_SIZE = HASH_SIZE * HIGHFREQ_FACTOR
+
+# same resample filter imagehash uses
+if hasattr(Image, "Resampling"):
+    ANTIALIAS = Image.Resampling.LANCZOS
+else:
+    ANTIALIAS = Image.ANTIALIAS
+
+
+def phash_pixels(image):
+    # exactly what imagehash.phash does before the dct
+    return np.asarray(image.convert("L").resize((IMG_SIZE, IMG_SIZE), ANTIALIAS))
+
+
+def batch_phash(pixels):
+    # pixels is an (N, 32, 32) uint8 stack, returns an (N,) uint64 array of phashes
+    # scipy's dct along each axis of the stack does the same math per image as imagehash,
+    # so the floats (and the median comparisons) come out identical
+    pixels = np.asarray(pixels)
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    dctlowfreq = dct[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    medians = np.median(dctlowfreq, axis=1)
+    bits = dctlowfreq > medians[:, None]
+
+    # imagehash's hex puts the first bit first, so big endian
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def verify_batch_phash(images):
+    # images can be paths or PIL images, returns how many hashes didn't match imagehash
+    import imagehash
+
+    pixels = []
+    expected = []
+    for image in images:
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        pixels.append(phash_pixels(image))
+        expected.append(int(str(imagehash.phash(image)), 16))
+
+    hashes = batch_phash(np.stack(pixels))
+    return sum(1 for phash, value in zip(hashes.tolist(), expected) if phash != value)
+
+
+def fixture_images(count=200, seed=0):
+    # a mix of noise, gradients and flat images, in the modes we see in libraries
+    rng = np.random.default_rng(seed)
+    modes = ["RGB", "L", "RGBA", "P"]
+    for i in range(count):
+        width, height = rng.integers(8, 800, size=2)
+        kind = i % 3
+        if kind == 0:
+            array = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        elif kind == 1:
+            gradient = np.linspace(0, 255, width, dtype=np.float64)
+            array = np.repeat(gradient[None, :, None], height, axis=0)
+            array = np.repeat(array, 3, axis=2).astype(np.uint8)
+        else:
+            array = np.full((height, width, 3), rng.integers(0, 256), dtype=np.uint8)
+
+        image = Image.fromarray(array, "RGB")
+        mode = modes[i % len(modes)]
+        yield image.convert(mode) if mode != "RGB" else image
+
+
+def main():
+    # python phash_kernel.py [image or directory ...]
+    # with no arguments it checks a generated fixture set
+    images = []
+    for arg in sys.argv[1:]:
+        path = Path(arg)
+        if path.is_dir():
+            images.extend(
+                p for p in path.rglob("*") if p.suffix.lower() in image_extensions
+            )
+        else:
+            images.append(path)
+
+    if not images:
+        images = list(fixture_images())
+
+    mismatches = verify_batch_phash(images)
+    print(f"Checked {len(images)} images, {mismatches} mismatches.")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 import os
 import sys
-import cv2
 import json
 import shutil
 import sqlite3
@@ -8,12 +7,28 @@ import argparse
 import subprocess
 
 from pathlib import Path
-from build_db import build_and_populate_database
+from build_db import build_and_populate_database, migrate_database
+from frame_cache import FrameCache
+from file_record import FILE_RECORD_FIELDS, FileTable, group_records_by_phash
+from directory_listing import DirectoryListingCache
+from frame_compare import frame_mse, is_image_match, is_video_match
+from match_prefetch import MatchPrefetcher, estimate_comparison_bytes
+from phash_index import (
+    MultiIndexHash,
+    build_index,
+    group_near_duplicates,
+    phash_to_hex,
+    phash_to_signed,
+)
 
 from user_config import database_path
 from user_config import blacklisted_phash_path
 from user_config import readable_size, readable_duration
 from user_config import trash_directory, collections_directory
+from user_config import frame_cache_path, frame_cache_max_bytes, frame_cache_max_size
+from user_config import prefetch_workers, prefetch_max_bytes
+from user_config import video_match_thumbnail_size
+from user_config import directory_listing_ttl, directory_listing_workers
 
 os.system("title remove_dupes.py")
 
@@ -29,6 +44,16 @@ parser.add_argument(
     action="store_true",
     help="Rebuild our database with new data from StashApp",
 )
+parser.add_argument(
+    "--sync-database",
+    action="store_true",
+    help="Sync only what changed in StashApp, keeping our injected image phashes",
+)
+parser.add_argument(
+    "--extraction-strategy",
+    choices=["legacy", "preaggregated"],
+    help="Override value for extraction_strategy",
+)
 parser.add_argument(
     "--auto-delete", action="store_true", help="Override value for auto_delete"
 )
@@ -66,8 +91,39 @@ parser.add_argument(
 parser.add_argument(
     "--mse-video-threshold", type=int, help="Override value for mse_video_threshold"
 )
+parser.add_argument(
+    "--max-phash-distance",
+    type=int,
+    help="Override value for max_phash_distance (0 = exact matches only)",
+)
+parser.add_argument(
+    "--near-match-index",
+    choices=["bktree", "mih", "numpy"],
+    help="Override value for near_match_index",
+)
+parser.add_argument("--mih-bands", type=int, help="Override value for mih_bands")
+parser.add_argument(
+    "--near-match-clustering",
+    choices=["seed", "transitive"],
+    help="Override value for near_match_clustering",
+)
+parser.add_argument(
+    "--max-group-diameter", type=int, help="Override value for max_group_diameter"
+)
+parser.add_argument(
+    "--prefetch-groups", type=int, help="Override value for prefetch_groups"
+)
+parser.add_argument(
+    "--video-match-samples",
+    type=int,
+    help="Override value for video_match_samples (1 = first frame only)",
+)
 args = parser.parse_args()
 
+if args.extraction_strategy:
+    extraction_strategy = args.extraction_strategy
+else:
+    from user_config import extraction_strategy
 if args.auto_delete:
     auto_delete = args.auto_delete
 else:
@@ -112,12 +168,61 @@ if args.mse_video_threshold:
     mse_video_threshold = args.mse_video_threshold
 else:
     from user_config import mse_video_threshold
+if args.max_phash_distance is not None:
+    max_phash_distance = args.max_phash_distance
+else:
+    from user_config import max_phash_distance
+if args.near_match_index:
+    near_match_index = args.near_match_index
+else:
+    from user_config import near_match_index
+if args.mih_bands:
+    mih_bands = args.mih_bands
+else:
+    from user_config import mih_bands
+if args.near_match_clustering:
+    near_match_clustering = args.near_match_clustering
+else:
+    from user_config import near_match_clustering
+if args.max_group_diameter is not None:
+    max_group_diameter = args.max_group_diameter
+else:
+    from user_config import max_group_diameter
+if args.prefetch_groups is not None:
+    prefetch_groups = args.prefetch_groups
+else:
+    from user_config import prefetch_groups
+if args.video_match_samples:
+    video_match_samples = args.video_match_samples
+else:
+    from user_config import video_match_samples
+
+
+# text columns where stash (or an old build) can leave "" or "None", they come back as NULL
+NULLABLE_TEXT_COLUMNS = {
+    "file_model",
+    "file_basename",
+    "file_parent",
+    "file_path",
+    "media_type",
+    "video_codec",
+    "audio_codec",
+    "video_format",
+}
+
+# the columns FileTable expects, in order
+PHASH_ROW_COLUMNS = ", ".join(
+    f"NULLIF(NULLIF({column}, ''), 'None') AS {column}"
+    if column in NULLABLE_TEXT_COLUMNS
+    else column
+    for column in FILE_RECORD_FIELDS
+)
 
 
 def prime_media_output(biggest_file_entry, smaller_file_entry):
     data = {
-        "biggest_file_entry": biggest_file_entry,
-        "smaller_file_entry": smaller_file_entry,
+        "biggest_file_entry": biggest_file_entry.to_dict(),
+        "smaller_file_entry": smaller_file_entry.to_dict(),
     }
 
     json_data = json.dumps(data)
@@ -132,9 +237,36 @@ def file_to_list(file_path):
         return [line.strip() for line in f]
 
 
+def load_blacklisted_phashes(file_path):
+    # the blacklist stays hex so it's easy to read and edit, old 17 character hex works too
+    # but the database stores integers, so that's what we compare against
+    blacklisted_phashes = set()
+    for line in file_to_list(file_path):
+        if not line:
+            continue
+        try:
+            blacklisted_phashes.add(phash_to_signed(line))
+        except ValueError:
+            print(f"Skipping invalid blacklisted phash: {line}")
+    return blacklisted_phashes
+
+
 class pHashProcessor:
     def __init__(self):
-        self.BLACKLISTED_PHASHES = file_to_list(blacklisted_phash_path)
+        self.BLACKLISTED_PHASHES = load_blacklisted_phashes(blacklisted_phash_path)
+        self.frame_cache = FrameCache(
+            frame_cache_path, frame_cache_max_bytes, frame_cache_max_size
+        )
+        self.file_listing = DirectoryListingCache(
+            directory_listing_ttl, directory_listing_workers
+        )
+        self.filter_drop_counts = {}
+        self.sql_filter_drop_counts = {}
+        # kept after grouping so its stats can be printed once the screen is cleared
+        self.near_match_index = None
+        self.prefetcher = None
+        # file_path -> duration from stash, so sampling videos doesn't have to probe them
+        self.durations = {}
 
     def connect_to_database(self, database_path):
         conn = sqlite3.connect(database_path)
@@ -143,144 +275,310 @@ class pHashProcessor:
     def disconnect_from_database(self, conn):
         conn.close()
 
-    def read_rows_with_phash(self, conn):
+    def stage_blacklisted_phashes(self, conn, blacklisted_phashes):
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS blacklisted_phashes (phash INTEGER PRIMARY KEY)"
+        )
+        cursor.execute("DELETE FROM temp.blacklisted_phashes")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO temp.blacklisted_phashes (phash) VALUES (?)",
+            [(phash,) for phash in blacklisted_phashes],
+        )
+
+    def read_rows_with_phash(self, conn, blacklisted_phashes=()):
+        # blacklisted phashes are left out here, so they never get loaded
+        self.stage_blacklisted_phashes(conn, blacklisted_phashes)
         cursor = conn.cursor()
         cursor.execute(
-            """
-            SELECT file_id, scene_id, file_model, file_basename, file_parent, file_path, file_size,
-                media_type, phash, duration, video_codec, audio_codec, video_format, width, height,
-                bit_rate, frame_rate
+            f"""
+            SELECT {PHASH_ROW_COLUMNS}
             FROM files
             WHERE phash IS NOT NULL
+            AND phash NOT IN (SELECT phash FROM temp.blacklisted_phashes)
         """
         )
-        rows = cursor.fetchall()
-        return rows
+        # the cursor itself, FileTable reads it a row at a time so the whole library is never a list of tuples
+        return cursor
 
-    def build_dict_from_rows(self, rows):
-        column_names = [
-            "file_id",
-            "scene_id",
-            "file_model",
-            "file_basename",
-            "file_parent",
-            "file_path",
-            "file_size",
-            "media_type",
-            "phash",
-            "duration",
-            "video_codec",
-            "audio_codec",
-            "video_format",
-            "width",
-            "height",
-            "bit_rate",
-            "frame_rate",
+    def compile_sql_group_filters(
+        self, min_size=None, min_duration=None, whitelist=None, blacklist=None
+    ):
+        # the same filters as compile_group_filters, as (name, condition, params) on a GROUP BY phash
+        # conditions are on the whole group, the names match so drop counts line up
+        def placeholders(values):
+            return ", ".join("?" for _ in values)
+
+        filters = [
+            (
+                "blacklisted phash",
+                "phash NOT IN (SELECT phash FROM temp.blacklisted_phashes)",
+                [],
+            ),
+            ("single file", "COUNT(*) > 1", []),
+            (
+                "media type",
+                f"""COUNT(DISTINCT media_type) = 1
+                AND SUM(media_type IS NULL OR media_type NOT IN ({placeholders(allowed_media_types)})) = 0""",
+                list(allowed_media_types),
+            ),
         ]
-        result = []
-        for row in rows:
-            item = {}
-            for i, value in enumerate(row):
-                if value is None or value == "" or value == "None":
-                    item[column_names[i]] = None
-                else:
-                    item[column_names[i]] = value
-            result.append(item)
-        return result
 
-    def get_curated_grouped_entries(
+        if whitelist not in (None, []):
+            filters.append(
+                (
+                    "whitelist",
+                    f"SUM(COALESCE(file_model IN ({placeholders(whitelist)}), 0)) > 0",
+                    list(whitelist),
+                )
+            )
+
+        if blacklist not in (None, []):
+            filters.append(
+                (
+                    "blacklist",
+                    f"SUM(COALESCE(file_model IN ({placeholders(blacklist)}), 0)) = 0",
+                    list(blacklist),
+                )
+            )
+
+        if min_size:
+            filters.append(("min size", "SUM(file_size) >= ?", [min_size]))
+
+        if "image" not in allowed_media_types and min_duration is not None:
+            filters.append(
+                (
+                    "min duration",
+                    "SUM(duration IS NULL) = 0 AND SUM(duration) >= ?",
+                    [min_duration],
+                )
+            )
+
+        return filters
+
+    def read_duplicate_candidates(
         self,
-        result_dict,
+        conn,
+        blacklisted_phashes=(),
         min_size=None,
         min_duration=None,
         whitelist=None,
         blacklist=None,
     ):
-        # Create curated grouped_entries with only groups containing more than one entry
-        curated_grouped_entries = {
-            phash: group for phash, group in result_dict.items() if len(group) > 1
-        }
+        # exact matching only: sqlite groups by phash (off idx_files_phash_group) and applies every
+        # group filter, so only rows of groups that can still be duplicates ever reach python
+        self.stage_blacklisted_phashes(conn, blacklisted_phashes)
+        filters = self.compile_sql_group_filters(
+            min_size=min_size,
+            min_duration=min_duration,
+            whitelist=whitelist,
+            blacklist=blacklist,
+        )
+        cursor = conn.cursor()
 
-        # If whitelist is not None, remove groups where AN entity["file_model"] in a group is not equal to whitelist
-        # I.e. at least one entry in a group must match the whitelist, not ALL entries
-        if whitelist not in (None, []):
-            curated_grouped_entries = {
-                phash: group
-                for phash, group in curated_grouped_entries.items()
-                if any(entry["file_model"] in whitelist for entry in group)
-            }
-
-        # if blacklist is not none or in [], remove all groups where at least one entry in the group is in the blacklist
-        # i.e. at least one entry in a group must match the blacklist, not ALL entries
-        if blacklist not in (None, []):
-            curated_grouped_entries = {
-                phash: group
-                for phash, group in curated_grouped_entries.items()
-                if not any(entry["file_model"] in blacklist_models for entry in group)
-            }
-
-        # Filter out entries where phash is None or nothing
-        curated_grouped_entries = {
-            phash: group
-            for phash, group in curated_grouped_entries.items()
-            if not any(phash_value in (None, "", "None") for phash_value in (phash,))
-        }
+        # NULL would fall through the CASE (and HAVING), so a condition that can't be worked out drops the group
+        dropped_by = " ".join(
+            f"WHEN NOT COALESCE(({condition}), 0) THEN ?" for _, condition, _ in filters
+        )
+        dropped_by_params = []
+        for name, _, params in filters:
+            dropped_by_params.extend(params)
+            dropped_by_params.append(name)
 
-        # Filter out entries with non-existent file paths
-        # while making sure we only preserve groups with more than one entry
-        curated_grouped_entries = {
-            phash: group
-            for phash, group in curated_grouped_entries.items()
-            if len(group) > 1
-            and all(os.path.exists(entry["file_path"]) for entry in group)
-        }
+        cursor.execute(
+            f"""
+            SELECT dropped_by, COUNT(*) FROM (
+                SELECT CASE {dropped_by} ELSE NULL END AS dropped_by
+                FROM files
+                WHERE phash IS NOT NULL
+                GROUP BY phash
+            )
+            GROUP BY dropped_by
+        """,
+            dropped_by_params,
+        )
+        self.sql_filter_drop_counts = {name: 0 for name, _, _ in filters}
+        for name, count in cursor.fetchall():
+            if name is not None:
+                self.sql_filter_drop_counts[name] = count
 
-        # we need to remove groups that don't match the allowed_media_types
-        # if all entries in a group have a media_type of "video", then we can keep the group
-        # if all entries in a group have a media_type of "image", then we remove the group
-        # if a group has a mix; i.e. some entries are "video" and some are "image", or some are "None", then we remove the group
-        curated_grouped_entries = {
-            phash: group
-            for phash, group in curated_grouped_entries.items()
-            if all(entry["media_type"] in allowed_media_types for entry in group)
-            and len(set(entry["media_type"] for entry in group)) == 1
-        }
+        having = " AND ".join(
+            f"COALESCE(({condition}), 0)" for _, condition, _ in filters
+        )
+        having_params = [param for _, _, params in filters for param in params]
+        cursor.execute(
+            f"""
+            SELECT {PHASH_ROW_COLUMNS}
+            FROM files
+            WHERE phash IN (
+                SELECT phash FROM files
+                WHERE phash IS NOT NULL
+                GROUP BY phash
+                HAVING {having}
+            )
+        """,
+            having_params,
+        )
+        rows = cursor.fetchall()
+        return rows
+
+    def build_records_from_rows(self, rows):
+        return FileTable(rows)
+
+    def compile_group_filters(
+        self, min_size=None, min_duration=None, whitelist=None, blacklist=None
+    ):
+        # (name, predicate) pairs, cheapest first, a group is kept if every predicate returns True
+        # only filters that can actually drop something are included
+        filters = [
+            # groups with only one entry aren't duplicates
+            ("single file", lambda phash, group: len(group) > 1),
+            ("no phash", lambda phash, group: phash not in (None, "", "None")),
+            # all entries must be one of allowed_media_types, and all the same media_type
+            (
+                "media type",
+                lambda phash, group: all(
+                    entry["media_type"] in allowed_media_types for entry in group
+                )
+                and len(set(entry["media_type"] for entry in group)) == 1,
+            ),
+        ]
+
+        # at least one entry in a group must match the whitelist, not ALL entries
+        if whitelist not in (None, []):
+            whitelist = set(whitelist)
+            filters.append(
+                (
+                    "whitelist",
+                    lambda phash, group: any(
+                        entry["file_model"] in whitelist for entry in group
+                    ),
+                )
+            )
 
-        # if min_size, filter out groups with total size less than min_size
-        if min_size is not None:
-            curated_grouped_entries = {
-                phash: group
-                for phash, group in curated_grouped_entries.items()
-                if sum(entry["file_size"] for entry in group) >= min_size
-            }
+        # remove all groups where at least one entry in the group is in the blacklist
+        if blacklist not in (None, []):
+            blacklist = set(blacklist)
+            filters.append(
+                (
+                    "blacklist",
+                    lambda phash, group: not any(
+                        entry["file_model"] in blacklist for entry in group
+                    ),
+                )
+            )
+
+        if min_size:
+            filters.append(
+                (
+                    "min size",
+                    lambda phash, group: sum(entry["file_size"] for entry in group)
+                    >= min_size,
+                )
+            )
 
         # filter for min_duration if all entries in a group contain a duration
         # idk whats wrong with my logic, so it only works if "image" is not in allowed_media_types
-        if "image" not in allowed_media_types:
-            if min_duration is not None:
-                curated_grouped_entries = {
-                    phash: group
-                    for phash, group in curated_grouped_entries.items()
-                    if all(
+        if "image" not in allowed_media_types and min_duration is not None:
+            filters.append(
+                (
+                    "min duration",
+                    lambda phash, group: all(
                         entry["duration"] is not None and entry["duration"] != "None"
                         for entry in group
                     )
-                    and sum(float(entry["duration"]) for entry in group) >= min_duration
-                }
+                    and sum(float(entry["duration"]) for entry in group)
+                    >= min_duration,
+                )
+            )
+
+        return filters
+
+    def get_curated_grouped_entries(
+        self,
+        result_dict,
+        min_size=None,
+        min_duration=None,
+        whitelist=None,
+        blacklist=None,
+    ):
+        # one pass over the groups with every cheap filter, then the filesystem check on whatever's left
+        # each dropped group is counted against the first filter that rejected it
+        filters = self.compile_group_filters(
+            min_size=min_size,
+            min_duration=min_duration,
+            whitelist=whitelist,
+            blacklist=blacklist,
+        )
+        self.filter_drop_counts = {name: 0 for name, _ in filters}
+        self.filter_drop_counts["missing files"] = 0
+
+        candidate_groups = {}
+        for phash, group in result_dict.items():
+            for name, predicate in filters:
+                if not predicate(phash, group):
+                    self.filter_drop_counts[name] += 1
+                    break
+            else:
+                candidate_groups[phash] = group
+
+        # Filter out groups with non-existent file paths
+        # every folder is listed once up front, so this doesn't hit the disk per file
+        self.file_listing.prefetch(
+            [entry["file_path"] for group in candidate_groups.values() for entry in group]
+        )
+        curated_grouped_entries = {}
+        for phash, group in candidate_groups.items():
+            if all(self.file_listing.exists(entry["file_path"]) for entry in group):
+                curated_grouped_entries[phash] = group
+            else:
+                self.filter_drop_counts["missing files"] += 1
 
         return curated_grouped_entries
 
-    def group_by_phash(self, entries, exact_match=True, blacklisted_phashes=[]):
+    def print_filter_drop_counts(self):
+        # groups sqlite already dropped (exact matching) plus what was dropped here
+        drop_counts = dict(self.sql_filter_drop_counts)
+        for name, count in self.filter_drop_counts.items():
+            drop_counts[name] = drop_counts.get(name, 0) + count
+
+        print("Groups dropped by:")
+        for name, count in drop_counts.items():
+            print(f"{name}: {count}")
+        print()
+
+    def print_near_match_stats(self):
+        # how much work the multi-index hashing bands saved vs brute force
+        if isinstance(self.near_match_index, MultiIndexHash):
+            self.near_match_index.print_stats()
+
+    def group_by_phash(
+        self,
+        entries,
+        exact_match=True,
+        blacklisted_phashes=[],
+        max_distance=0,
+        index_type="bktree",
+        bands=None,
+        clustering="seed",
+        max_diameter=None,
+    ):
         if exact_match:
-            groups = {}
-            for entry in entries:
-                phash = entry["phash"]
-                if entry["phash"] not in blacklisted_phashes:
-                    if phash in groups:
-                        groups[phash].append(entry)
-                    else:
-                        groups[phash] = [entry]
-            return groups
+            return group_records_by_phash(entries, blacklisted_phashes)
+
+        # near-duplicate mode, group the exact matches first, then merge phashes
+        # that are within max_distance bits of each other using a bk-tree or multi-index hashing
+        exact_groups = self.group_by_phash(
+            entries, exact_match=True, blacklisted_phashes=blacklisted_phashes
+        )
+        self.near_match_index = build_index(index_type, max_distance, bands)
+        return group_near_duplicates(
+            exact_groups,
+            max_distance,
+            clustering=clustering,
+            max_diameter=max_diameter,
+            index=self.near_match_index,
+        )
 
     def process_grouped_entries(self, grouped_entries, auto_delete=False):
         # print how many groups exist in curated_grouped_entries
@@ -301,20 +599,96 @@ class pHashProcessor:
         }
 
         # Sort groups by summed file size in descending order
+        # near-duplicate groups can hold several phashes, so we keep the group key around
         sorted_groups = sorted(
-            grouped_entries.values(),
-            key=lambda group: group_sizes[group[0]["phash"]],
+            grouped_entries.items(),
+            key=lambda item: group_sizes[item[0]],
             reverse=True,
         )
 
-        # Print the summed file size for each group
-        for group in sorted_groups:
-            phash_value = group[0]["phash"]
-            print(
-                f"Group - phash: {phash_value} (Summed File Size: {readable_size(group_sizes[phash_value])})"
+        self.durations = {
+            entry["file_path"]: entry["duration"]
+            for group in grouped_entries.values()
+            for entry in group
+            if entry["duration"]
+        }
+
+        # while we wait on input for one group, the next prefetch_groups are already being checked
+        if prefetch_groups:
+            self.prefetcher = MatchPrefetcher(
+                self.compute_frames_match, prefetch_workers, prefetch_max_bytes
             )
 
-            self.process_delete_files(group, auto_delete=auto_delete)
+        try:
+            # Print the summed file size for each group
+            for index, (phash_value, group) in enumerate(sorted_groups):
+                if self.prefetcher is not None:
+                    for ahead in range(
+                        index, min(index + prefetch_groups + 1, len(sorted_groups))
+                    ):
+                        if not self.prefetcher.is_submitted(ahead):
+                            self.prefetcher.submit(
+                                ahead,
+                                self.planned_comparisons(
+                                    sorted_groups[ahead][1], auto_delete
+                                ),
+                            )
+
+                print(
+                    f"Group - phash: {phash_to_hex(phash_value)} (Summed File Size: {readable_size(group_sizes[phash_value])})"
+                )
+
+                self.process_delete_files(group, auto_delete=auto_delete)
+
+                if self.prefetcher is not None:
+                    self.prefetcher.release(index)
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+                self.prefetcher = None
+
+    def planned_comparisons(self, group, auto_delete=False):
+        # the is_frames_match calls process_group can make for this group in this mode, so they can be prefetched
+        media_type = self.get_group_media_type(group)
+        if media_type not in ("video", "image"):
+            # mixed groups stop and wait for enter, that has to happen on the main thread
+            return []
+
+        sorted_files = self.sort_files_by_size(group)
+        premium_files, non_premium_files = self.separate_premium_and_non_premium_files(
+            sorted_files
+        )
+        ordered_files = premium_files + non_premium_files
+        biggest_file = self.find_biggest_file(group, premium_files)
+        file_models = set(entry["file_model"] for entry in group)
+
+        entry_sets = []
+        if auto_delete or len(file_models) > 1:
+            entry_sets.append(ordered_files)
+
+        if len(file_models) == 1:
+            entry_sets.extend(
+                [entry, biggest_file] for entry in ordered_files if entry != biggest_file
+            )
+        elif not auto_delete:
+            # auto-delete skips groups with different models right after the first check
+            # otherwise which files get compared last depends on the model picked, so that's all of them
+            for file_model in file_models:
+                biggest_file_with_model = max(
+                    (entry for entry in group if entry["file_model"] == file_model),
+                    key=lambda entry: entry["file_size"],
+                )
+                entry_sets.append([biggest_file_with_model, biggest_file])
+            entry_sets.extend([entry, biggest_file] for entry in group)
+
+        return [
+            (
+                [entry["file_path"] for entry in entries],
+                media_type,
+                estimate_comparison_bytes(entries),
+            )
+            for entries in entry_sets
+        ]
 
     def sort_files_by_size(self, group):
         return sorted(group, key=lambda entry: entry["file_size"], reverse=True)
@@ -342,9 +716,8 @@ class pHashProcessor:
                     biggest_file = entry
         return biggest_file
 
-    def process_group(self, group, auto_delete=False):
-        # Determine media type of group
-        media_type = (
+    def get_group_media_type(self, group):
+        return (
             "video"
             if all(entry["media_type"] == "video" for entry in group)
             else "image"
@@ -354,6 +727,10 @@ class pHashProcessor:
             else "mixed"
         )
 
+    def process_group(self, group, auto_delete=False):
+        # Determine media type of group
+        media_type = self.get_group_media_type(group)
+
         sorted_files = self.sort_files_by_size(group)
         premium_files, non_premium_files = self.separate_premium_and_non_premium_files(
             sorted_files
@@ -458,7 +835,7 @@ class pHashProcessor:
             [entry["file_path"] for entry in premium_files + non_premium_files],
             media_type,
         ):
-            print(f"pHash: {biggest_file['phash']}")
+            print(f"pHash: {phash_to_hex(biggest_file['phash'])}")
             print("Frames do not match for all files in group. Be weary!\n")
 
             if auto_delete:
@@ -539,6 +916,14 @@ class pHashProcessor:
         self.process_group(group, auto_delete)
 
     def is_frames_match(self, file_paths, media_type=None):
+        if self.prefetcher is not None:
+            frames_match = self.prefetcher.result(file_paths, media_type)
+            if frames_match is not None:
+                return frames_match
+
+        return self.compute_frames_match(file_paths, media_type)
+
+    def compute_frames_match(self, file_paths, media_type=None):
         def is_video(path):
             if media_type == "video":
                 return True
@@ -547,24 +932,46 @@ class pHashProcessor:
             if media_type == "image":
                 return True
 
+        def get_video_samples(path):
+            return self.frame_cache.get_video_samples(
+                path,
+                video_match_samples,
+                video_match_thumbnail_size,
+                self.durations.get(path),
+            )
+
+        def is_video_samples_match(video_paths):
+            try:
+                samples1 = get_video_samples(video_paths[0])
+
+                for path in video_paths[1:]:
+                    samples2 = get_video_samples(path)
+
+                    if samples1 is None or samples2 is None:
+                        return False
+
+                    if not is_video_match(
+                        samples1, samples2, video_match_samples, mse_video_threshold
+                    ):
+                        return False
+
+                return True
+
+            except Exception as e:
+                print(f"An error occurred: {str(e)}")
+                return False
+
         def is_video_frames_match(video_paths):
             try:
-                cap = cv2.VideoCapture(video_paths[0])
-                ret, frame1 = cap.read()
-                cap.release()
+                frame1 = self.frame_cache.get_frame(video_paths[0], "video")
 
                 for path in video_paths[1:]:
-                    cap = cv2.VideoCapture(path)
-                    ret, frame2 = cap.read()
-                    cap.release()
+                    frame2 = self.frame_cache.get_frame(path, "video")
 
                     if frame1 is None or frame2 is None:
                         return False
 
-                    if frame1.shape != frame2.shape:
-                        frame1 = cv2.resize(frame1, frame2.shape[:2][::-1])
-
-                    mse = ((frame1 - frame2) ** 2).mean()
+                    mse = frame_mse(frame1, frame2)
 
                     if mse > mse_video_threshold:
                         return False
@@ -576,31 +983,20 @@ class pHashProcessor:
                 return False
 
         def is_image_frames_match(image_paths):
-            patch_size = 128
             try:
-                frame1 = cv2.imread(image_paths[0])
+                frame1 = self.frame_cache.get_frame(image_paths[0], "image")
 
                 if frame1 is None:
                     return False
 
                 for path in image_paths[1:]:
-                    frame2 = cv2.imread(path)
+                    frame2 = self.frame_cache.get_frame(path, "image")
 
                     if frame2 is None:
                         return False
 
-                    for i in range(0, frame1.shape[0], patch_size):
-                        for j in range(0, frame1.shape[1], patch_size):
-                            patch1 = frame1[i : i + patch_size, j : j + patch_size]
-                            patch2 = frame2[i : i + patch_size, j : j + patch_size]
-
-                            if patch1.shape != patch2.shape:
-                                patch1 = cv2.resize(patch1, patch2.shape[:2][::-1])
-
-                            mse = ((patch1 - patch2) ** 2).mean()
-
-                            if mse > mse_image_threshold:
-                                return False
+                    if not is_image_match(frame1, frame2, mse_image_threshold):
+                        return False
 
             except Exception as e:
                 print(f"Error occurred: {e}")
@@ -610,6 +1006,8 @@ class pHashProcessor:
 
         try:
             if all(is_video(path) for path in file_paths):
+                if video_match_samples > 1:
+                    return is_video_samples_match(file_paths)
                 return is_video_frames_match(file_paths)
 
             if all(is_image(path) for path in file_paths):
@@ -650,6 +1048,10 @@ class pHashProcessor:
                 except PermissionError:
                     print(f"Could not move file to trash: {target_path}")
 
+            self.file_listing.invalidate(str(path))
+            if self.prefetcher is not None:
+                self.prefetcher.invalidate(path)
+
     def move_file(self, file_path, destination):
         source_path = Path(file_path)
         destination_path = Path(destination)
@@ -663,14 +1065,37 @@ class pHashProcessor:
 
 
 def remove_duplicates():
+    migrate_database(database_path)
+
     processor = pHashProcessor()
+    processor.frame_cache.connect()
     conn = processor.connect_to_database(database_path)
-    rows = processor.read_rows_with_phash(conn)
-    result_dict = processor.build_dict_from_rows(rows)
+    if max_phash_distance == 0:
+        # exact matching is grouped and filtered in sqlite, python only sees the duplicate candidates
+        rows = processor.read_duplicate_candidates(
+            conn,
+            blacklisted_phashes=processor.BLACKLISTED_PHASHES,
+            min_size=min_group_size,
+            min_duration=min_group_duration,
+            whitelist=whitelist_models,
+            blacklist=blacklist_models,
+        )
+    else:
+        rows = processor.read_rows_with_phash(
+            conn, blacklisted_phashes=processor.BLACKLISTED_PHASHES
+        )
+    result_dict = processor.build_records_from_rows(rows)
     processor.disconnect_from_database(conn)
 
     grouped_entries = processor.group_by_phash(
-        result_dict, blacklisted_phashes=processor.BLACKLISTED_PHASHES
+        result_dict,
+        exact_match=max_phash_distance == 0,
+        blacklisted_phashes=processor.BLACKLISTED_PHASHES,
+        max_distance=max_phash_distance,
+        index_type=near_match_index,
+        bands=mih_bands,
+        clustering=near_match_clustering,
+        max_diameter=max_group_diameter or None,
     )
 
     curated_grouped_entries = processor.get_curated_grouped_entries(
@@ -697,7 +1122,11 @@ def remove_duplicates():
             print(f"{arg}: {getattr(args, arg)}")
     print()
 
+    processor.print_filter_drop_counts()
+    processor.print_near_match_stats()
+
     processor.process_grouped_entries(curated_grouped_entries, auto_delete=auto_delete)
+    processor.frame_cache.disconnect()
 
     print()
 
@@ -706,25 +1135,35 @@ def main():
     os.system("cls" if os.name == "nt" else "clear")
 
     if args.rebuild_database:
-        build_and_populate_database()
+        build_and_populate_database(strategy=extraction_strategy)
+    if args.sync_database:
+        build_and_populate_database(
+            incremental=True, strategy=extraction_strategy
+        )
     if args.remove_duplicates:
         remove_duplicates()
 
-    if not (args.remove_duplicates or args.rebuild_database):
+    if not (args.remove_duplicates or args.rebuild_database or args.sync_database):
         while True:
             print("\nWhat would you like to do?\n")
             print("1. Remove duplicate files    [--remove-duplicates]")
             print("2. Rebuild database          [--rebuild-database]")
-            print("3. Exit\n")
+            print("3. Sync database             [--sync-database]")
+            print("4. Exit\n")
             choice = input("Enter your choice: ")
 
             if choice == "1":
                 remove_duplicates()
                 break
             elif choice == "2":
-                build_and_populate_database()
+                build_and_populate_database(strategy=extraction_strategy)
                 break
             elif choice == "3":
+                build_and_populate_database(
+                    incremental=True, strategy=extraction_strategy
+                )
+                break
+            elif choice == "4":
                 sys.exit()
             else:
                 print("Invalid choice. Please try again.")
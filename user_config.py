@@ -27,17 +27,47 @@ def readable_duration(float):
 # path to your stash database [we're only reading from it, but it's still a good idea to make a backup]
 stash_database_path = Path("path/to/stash/database.sqlite")
 
+# how we read from stash, both give the same rows. "preaggregated" is faster, "legacy" is the original query
+# benchmark_extraction.py compares them
+extraction_strategy = "preaggregated"
+
 # paths to all the files/dirs we're going to be using
 data_directory = Path(__file__).parent / "data"
 blacklisted_phash_path = data_directory / "blacklisted_phashes.txt"
 database_path = data_directory / "stash_data.sqlite"
 phashes_path = data_directory / "phashes.csv"
 processed_images_path = data_directory / "phashed_file_ids.txt"
+phash_checkpoint_path = data_directory / "phash_checkpoint.sqlite"
+phash_cache_max_entries = 1000000  # md5/oshash -> phash cache, only deleted files are evicted past this
+
+# image_phash_util.py
+phash_workers = 0  # worker processes for hashing images, 0 = all cores
+phash_chunk_size = 64  # images handed to a worker at a time
+# decode images at reduced size before hashing, much faster on big photos, but the phash can
+# differ from a full decode. check how much with: image_phash_util.py --validate-fast-decode 500
+fast_phash_decode = False
+# image_phash_util.py --videos, seconds a single video can take before its worker is killed
+video_phash_timeout = 300
 
 direct_delete = False
 trash_directory = Path("path/to/trash/directory") # folder you dedicate to trash, so you can easily restore stuff
 collections_directory = Path("path/to/your/isos") # main root folder for your collections
-extracted_frames_path = Path("path/to/your/extracted/frames") # this dir gets deleted each call
+
+# first frames used to check matches (and shown by file_comparison_gui.py), cached so each file is only decoded once
+# the mse thresholds below are measured on these, so changing frame_cache_max_size can change what matches
+frame_cache_path = data_directory / "frame_cache"
+frame_cache_max_bytes = 2 * 1024**3  # least recently used frames are deleted past this
+frame_cache_max_size = 1024  # longest side frames are scaled down to, 0 = full resolution
+# while you answer for one group, the next prefetch_groups groups are checked in the background (0 = off)
+prefetch_groups = 4
+prefetch_workers = 4
+prefetch_max_bytes = 1024**3  # decoded frames the background checks can hold at once
+# videos are checked at this many timestamps across the whole video (1 = first frame only, which is often a black or intro frame)
+video_match_samples = 5
+video_match_thumbnail_size = 160  # longest side the sampled frames are compared at
+# files are checked for existence by listing their folders (once each, in parallel), not one by one
+directory_listing_workers = 16
+directory_listing_ttl = 60  # seconds a folder listing is trusted for
 
 auto_delete = False
 output_to_window = False
@@ -45,6 +75,16 @@ output_to_window = False
 mse_image_threshold = 40
 mse_video_threshold = 40
 
+# how many bits two phashes can differ by and still be grouped together (0 = exact matches only)
+max_phash_distance = 0
+# "bktree" is fine for most libraries, "mih" (multi-index hashing) scales better into the millions
+# "numpy" compares every pair with a vectorized kernel, fastest for smaller collections (tens of thousands)
+near_match_index = "bktree"
+mih_bands = 0  # 0 = max_phash_distance + 1
+# "seed" groups everything within max_phash_distance of the biggest group, "transitive" chains matches together (A~B~C)
+near_match_clustering = "seed"
+max_group_diameter = 0  # transitive only, max bits between any two phashes in a group (0 = no limit)
+
 prioritized_directories = ["premium"]
 allowed_media_types = ["video"]
 min_group_size = 0 * 1024 * 1024
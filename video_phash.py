@@ -0,0 +1,99 @@
+import cv2
+import numpy as np
+import scipy.fftpack
+
+from PIL import Image
+
+# video phashes the same way stash generates them (pkg/hash/videophash):
+# 25 frames, evenly spaced between 5% and 95% of the duration, each scaled to 160px wide,
+# pasted into a 5x5 sprite, and the sprite is hashed with goimagehash's PerceptionHash
+#
+# stash decodes with ffmpeg and resizes in go, we decode with opencv and resize with PIL,
+# so hashes land within a few bits of stash's rather than bit for bit.
+# group them against stash's phashes with --max-phash-distance
+
+SCREENSHOT_SIZE = 160
+COLUMNS = 5
+ROWS = 5
+
+# goimagehash's PerceptionHash
+PERCEPTION_IMG_SIZE = 64
+PERCEPTION_HASH_SIZE = 8
+
+
+def get_duration(capture):
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+    if fps and frame_count:
+        return frame_count / fps
+    return None
+
+
+def extract_sprite_frames(file_path, duration=None):
+    capture = cv2.VideoCapture(str(file_path))
+    try:
+        if not capture.isOpened():
+            raise ValueError("could not open video")
+
+        if not duration:
+            duration = get_duration(capture)
+        if not duration:
+            raise ValueError("could not determine duration")
+
+        offset = 0.05 * duration
+        step_size = (0.9 * duration) / (COLUMNS * ROWS)
+
+        frames = []
+        for i in range(COLUMNS * ROWS):
+            capture.set(cv2.CAP_PROP_POS_MSEC, (offset + i * step_size) * 1000)
+            success, frame = capture.read()
+            if not success:
+                raise ValueError(f"could not read frame {i + 1} of {COLUMNS * ROWS}")
+            frames.append(frame)
+
+        return frames
+    finally:
+        capture.release()
+
+
+def build_sprite(frames):
+    # same as ffmpeg's scale=160:-2, width 160 and an even height
+    height, width = frames[0].shape[:2]
+    frame_height = max(2, int(round(height * SCREENSHOT_SIZE / width / 2)) * 2)
+
+    sprite = np.zeros(
+        (frame_height * ROWS, SCREENSHOT_SIZE * COLUMNS, 3), dtype=np.uint8
+    )
+    for index, frame in enumerate(frames):
+        frame = cv2.resize(
+            frame, (SCREENSHOT_SIZE, frame_height), interpolation=cv2.INTER_CUBIC
+        )
+        x = SCREENSHOT_SIZE * (index % COLUMNS)
+        y = frame_height * (index // ROWS)
+        sprite[y : y + frame_height, x : x + SCREENSHOT_SIZE] = frame
+
+    return Image.fromarray(cv2.cvtColor(sprite, cv2.COLOR_BGR2RGB))
+
+
+def perception_hash(image):
+    # goimagehash.PerceptionHash: 64x64 bilinear, luma, 2d dct, 8x8 low frequencies vs their median
+    # goimagehash's median is the upper middle value, not the average of the two middle values
+    image = image.convert("RGB").resize(
+        (PERCEPTION_IMG_SIZE, PERCEPTION_IMG_SIZE), Image.BILINEAR
+    )
+    pixels = np.asarray(image, dtype=np.float64)
+    gray = 0.299 * pixels[..., 0] + 0.587 * pixels[..., 1] + 0.114 * pixels[..., 2]
+
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(gray, axis=1), axis=0)
+    lowfreq = dct[:PERCEPTION_HASH_SIZE, :PERCEPTION_HASH_SIZE].ravel()
+    median = np.sort(lowfreq)[len(lowfreq) // 2]
+
+    phash = 0
+    for bit in lowfreq > median:
+        phash = (phash << 1) | int(bit)
+    return phash
+
+
+def hash_video(file_path, duration=None):
+    # unsigned 64 bit int, like stash's before it's stored
+    return perception_hash(build_sprite(extract_sprite_frames(file_path, duration)))